@@ -6,20 +6,20 @@ Watches a folder for new images and segments body parts using BodyPix
 
 import os
 import time
+import colorsys
 import queue
 import threading
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from pathlib import Path
-from typing import Set
+from typing import List, Set, Tuple
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-# BodyPix imports
-import tensorflow as tf
+# Image processing imports (TensorFlow comes in lazily with the BodyPix model)
 import numpy as np
-from PIL import Image
 import cv2
-from bodypix import BodyPix
 
 # Configure logging
 logging.basicConfig(
@@ -28,6 +28,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def _hash_part_color(part_name: str) -> tuple:
+    """Generate a consistent color for a body part from its name"""
+    # Simple hash-based color generation
+    hue = (hash(part_name) % 360) / 360.0
+    rgb = colorsys.hsv_to_rgb(hue, 0.8, 0.9)
+    return tuple(int(c * 255) for c in rgb)
+
 class BodyPixProcessor:
     """Handles BodyPix model loading and image processing"""
     
@@ -41,9 +48,64 @@ class BodyPixProcessor:
         'right_leg': ['right_hip', 'right_thigh', 'right_knee', 'right_shin', 'right_ankle', 'right_foot']
     }
     
+    # BodyPix part IDs (these are the standard BodyPix part IDs)
+    BODYPIX_PARTS = {
+        0: 'background',
+        1: 'torso_back',
+        2: 'torso_front',
+        3: 'left_arm',
+        4: 'right_arm',
+        5: 'left_leg',
+        6: 'right_leg',
+        7: 'head',
+        8: 'left_hand',
+        9: 'right_hand',
+        10: 'left_foot',
+        11: 'right_foot'
+    }
+    
+    # Colors for every known part name, computed once instead of per image
+    _PART_COLORS = {
+        name: _hash_part_color(name)
+        for name in [*(p for parts in BODY_PART_GROUPS.values() for p in parts), *BODYPIX_PARTS.values(), 'person']
+    }
+    
+    # Rectangles for the heuristic fallback as (name, (top, bottom), (left, right), min_pixels),
+    # in fractions of the frame. This is a simplified approach - real BodyPix would
+    # provide actual part segmentation
+    _HEURISTIC_REGIONS = [
+        # Head region (top 25% of body)
+        ('head', (0.0, 0.25), (0.0, 1.0), 100),
+        # Torso region (middle 40% of body)
+        ('torso', (0.25, 0.65), (0.0, 1.0), 100),
+        # Split torso into left and right arms
+        ('left_arm', (0.25, 0.65), (0.0, 1/3), 50),
+        ('right_arm', (0.25, 0.65), (2/3, 1.0), 50),
+        # Legs region (bottom 35% of body) split into left and right
+        ('left_leg', (0.65, 1.0), (0.0, 0.5), 100),
+        ('right_leg', (0.65, 1.0), (0.5, 1.0), 100)
+    ]
+    
+    # Longest side images are downscaled to before segmentation (None keeps full resolution)
+    WORK_SIZE = 512
+    
+    # zlib level for saved masks; flat-color masks barely shrink at higher levels
+    PNG_COMPRESSION = 1
+    
+    # Structuring element for the demo segmentation cleanup, built once
+    _MORPH_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    
     def __init__(self, model_path: str = None):
         self.model = None
-        self.processed_files: Set[str] = set()
+        # Bounded LRU of processed image names (the watcher is non-recursive,
+        # so a basename identifies a file and costs far less than a full path)
+        self.processed_files: OrderedDict = OrderedDict()
+        self._processed_cap = 100_000
+        self._processed_lock = threading.Lock()
+        self._dirs_ready = False
+        self._last_output_dir = None
+        self._bufs = {}
+        self._region_cache = {}
         self._load_model(model_path)
     
     def _load_model(self, model_path: str = None):
@@ -51,6 +113,9 @@ class BodyPixProcessor:
         try:
             logger.info("🤖 Loading BodyPix model...")
             
+            # Imported here so TensorFlow is only pulled in once a model is needed
+            from bodypix import BodyPix
+            
             # Initialize BodyPix with the tf-bodypix library
             # This will automatically download the model if not present
             self.model = BodyPix()
@@ -65,51 +130,120 @@ class BodyPixProcessor:
     def segment_image(self, image_path: str) -> dict:
         """Segment body parts in an image using real BodyPix"""
         try:
-            # Load image
-            image = Image.open(image_path).convert('RGB')
-            image_array = np.array(image)
-            
-            logger.info(f"📸 Processing: {os.path.basename(image_path)} ({image_array.shape[1]}x{image_array.shape[0]})")
-            
-            # Use real BodyPix for segmentation
-            segmentation_result = self.model.predict_single(image_array)
-            
-            return {
-                'success': True,
-                'image_path': image_path,
-                'segmentation': segmentation_result,
-                'body_parts': self._extract_body_parts_from_bodypix(segmentation_result)
-            }
+            image_array, original_size = self.load_image(image_path)
+            return self._segment_array(image_path, image_array, original_size)
             
         except Exception as e:
             logger.error(f"❌ Error segmenting image: {e}")
             return {'success': False, 'error': str(e)}
     
+    def segment_decoded(self, decoded: List[Tuple[str, object, Tuple[int, int]]]) -> List[dict]:
+        """Segment (image_path, image_array, original_size) entries from load_image
+        
+        An image_array that is an Exception (a failed decode) yields a failed result.
+        """
+        results = []
+        for image_path, image_array, original_size in decoded:
+            try:
+                if isinstance(image_array, Exception):
+                    raise image_array
+                results.append(self._segment_array(image_path, image_array, original_size))
+            except Exception as e:
+                logger.error(f"❌ Error segmenting image: {e}")
+                results.append({'success': False, 'error': str(e)})
+        
+        return results
+    
+    def is_processed(self, image_path: str) -> bool:
+        """Check whether an image has already been processed"""
+        key = os.path.basename(image_path)
+        with self._processed_lock:
+            if key in self.processed_files:
+                self.processed_files.move_to_end(key)
+                return True
+        return False
+    
+    def mark_processed(self, image_path: str):
+        """Record an image as processed, evicting the oldest entry when full"""
+        key = os.path.basename(image_path)
+        with self._processed_lock:
+            self.processed_files[key] = None
+            self.processed_files.move_to_end(key)
+            while len(self.processed_files) > self._processed_cap:
+                self.processed_files.popitem(last=False)
+    
+    def load_image(self, image_path: str) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Load an image as a BGR array at working resolution
+        
+        Returns the working image and the original (width, height).
+        """
+        # Decodes straight into a contiguous BGR array
+        image_array = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if image_array is None:
+            raise IOError(f"Could not read image: {image_path}")
+        
+        height, width = image_array.shape[:2]
+        original_size = (width, height)
+        
+        # Downscale once so every later stage touches far fewer pixels
+        if self.WORK_SIZE and max(width, height) > self.WORK_SIZE:
+            scale = self.WORK_SIZE / max(width, height)
+            work_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            image_array = cv2.resize(image_array, work_size, interpolation=cv2.INTER_AREA)
+        
+        return image_array, original_size
+    
+    def _segment_array(self, image_path: str, image_array: np.ndarray, original_size: Tuple[int, int]) -> dict:
+        """Run BodyPix on an image returned by load_image"""
+        logger.info(f"📸 Processing: {os.path.basename(image_path)} ({original_size[0]}x{original_size[1]}, working at {image_array.shape[1]}x{image_array.shape[0]})")
+        
+        # Use real BodyPix for segmentation (the model expects RGB input)
+        segmentation_result = self.model.predict_single(cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB))
+        
+        return {
+            'success': True,
+            'image_path': image_path,
+            'original_size': original_size,
+            'segmentation': segmentation_result,
+            'body_parts': self._extract_body_parts_from_bodypix(segmentation_result)
+        }
+    
     def _simple_segmentation(self, image: np.ndarray) -> np.ndarray:
-        """Simple segmentation for demonstration purposes"""
+        """Simple segmentation for demonstration purposes (expects a BGR image)
+        
+        The returned mask is a pooled buffer that the next call overwrites;
+        copy it if it has to outlive the current frame.
+        """
         # This is a placeholder - replace with actual BodyPix inference
         height, width = image.shape[:2]
         
-        # Create a simple segmentation mask (just for demo)
-        mask = np.zeros((height, width), dtype=np.uint8)
-        
         # Simple body detection using color and position heuristics
         # In practice, you'd use the actual BodyPix model
-        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
         
-        # Find skin-like regions (very basic)
+        # Find skin-like regions (very basic), writing into recycled buffers
         lower_skin = np.array([0, 20, 70], dtype=np.uint8)
         upper_skin = np.array([20, 255, 255], dtype=np.uint8)
-        hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-        skin_mask = cv2.inRange(hsv, lower_skin, upper_skin)
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=self._get_buf((height, width, 3), np.uint8))
+        skin_mask = cv2.inRange(hsv, lower_skin, upper_skin, dst=self._get_buf((height, width), np.uint8))
         
-        # Simple morphological operations
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        skin_mask = cv2.morphologyEx(skin_mask, cv2.MORPH_CLOSE, kernel)
-        skin_mask = cv2.morphologyEx(skin_mask, cv2.MORPH_OPEN, kernel)
+        # Simple morphological operations, in place to avoid per-frame allocations
+        cv2.morphologyEx(skin_mask, cv2.MORPH_CLOSE, self._MORPH_KERNEL, dst=skin_mask)
+        cv2.morphologyEx(skin_mask, cv2.MORPH_OPEN, self._MORPH_KERNEL, dst=skin_mask)
         
         return skin_mask
     
+    def _get_buf(self, shape: tuple, dtype) -> np.ndarray:
+        """Return a scratch buffer for this shape and dtype, reused across frames
+        
+        Only the inference thread uses the processor's buffers, so no locking.
+        """
+        key = (shape, np.dtype(dtype))
+        buf = self._bufs.get(key)
+        if buf is None:
+            buf = np.empty(shape, dtype=dtype)
+            self._bufs[key] = buf
+        return buf
+    
     def _extract_body_parts_from_bodypix(self, segmentation_result) -> list:
         """Extract body parts from BodyPix segmentation result"""
         body_parts = []
@@ -120,24 +254,8 @@ class BodyPixProcessor:
             if hasattr(segmentation_result, 'part_mask'):
                 part_mask = segmentation_result.part_mask
                 
-                # BodyPix part IDs (these are the standard BodyPix part IDs)
-                bodypix_parts = {
-                    0: 'background',
-                    1: 'torso_back',
-                    2: 'torso_front', 
-                    3: 'left_arm',
-                    4: 'right_arm',
-                    5: 'left_leg',
-                    6: 'right_leg',
-                    7: 'head',
-                    8: 'left_hand',
-                    9: 'right_hand',
-                    10: 'left_foot',
-                    11: 'right_foot'
-                }
-                
                 # Extract each body part
-                for part_id, part_name in bodypix_parts.items():
+                for part_id, part_name in self.BODYPIX_PARTS.items():
                     if part_id == 0:  # Skip background
                         continue
                     
@@ -217,71 +335,66 @@ class BodyPixProcessor:
         parts_detected = self._detect_body_parts_heuristic(mask, height, width)
         
         body_parts = []
-        for part_name, part_mask in parts_detected.items():
-            pixel_count = np.sum(part_mask > 0)
+        for part_name, (slice_y, slice_x, region, pixel_count) in parts_detected.items():
             if pixel_count > 0:
                 body_parts.append({
                     'name': part_name,
                     'pixel_count': int(pixel_count),
-                    'mask': part_mask,
+                    'mask': region,
+                    'offset': (slice_x.start, slice_y.start),
+                    'frame_size': (width, height),
                     'group': self._get_part_group(part_name)
                 })
         
         return body_parts
     
     def _detect_body_parts_heuristic(self, segmentation: np.ndarray, height: int, width: int) -> dict:
-        """Simple heuristic-based body part detection for demonstration"""
-        parts = {}
-        
-        # Create masks for different body regions based on position
-        # This is a simplified approach - real BodyPix would provide actual part segmentation
-        
-        # Head region (top 25% of body)
-        head_mask = np.zeros_like(segmentation)
-        head_region = segmentation[:height//4, :]
-        head_mask[:height//4, :] = head_region
-        
-        # Torso region (middle 40% of body)
-        torso_mask = np.zeros_like(segmentation)
-        torso_start = height//4
-        torso_end = int(height * 0.65)
-        torso_region = segmentation[torso_start:torso_end, :]
-        torso_mask[torso_start:torso_end, :] = torso_region
-        
-        # Legs region (bottom 35% of body)
-        legs_mask = np.zeros_like(segmentation)
-        legs_start = int(height * 0.65)
-        legs_region = segmentation[legs_start:, :]
-        legs_mask[legs_start:, :] = legs_region
-        
-        # Split legs into left and right
-        left_leg_mask = np.zeros_like(segmentation)
-        right_leg_mask = np.zeros_like(segmentation)
-        left_leg_mask[legs_start:, :width//2] = legs_region[:, :width//2]
-        right_leg_mask[legs_start:, width//2:] = legs_region[:, width//2:]
+        """Simple heuristic-based body part detection for demonstration
         
-        # Split torso into left and right arms
-        left_arm_mask = np.zeros_like(segmentation)
-        right_arm_mask = np.zeros_like(segmentation)
-        left_arm_mask[torso_start:torso_end, :width//3] = torso_region[:, :width//3]
-        right_arm_mask[torso_start:torso_end, 2*width//3:] = torso_region[:, 2*width//3:]
+        Returns {part_name: (slice_y, slice_x, region, pixel_count)} where region
+        is a view into segmentation, so no full-frame masks are allocated.
+        """
+        parts = {}
+        regions = self._heuristic_regions(height, width)
+        
+        # Count every pixel of the frame exactly once: the arm strips sit inside
+        # the torso rows, so the torso total is both arm counts plus the strip
+        # between them instead of a second scan over the arms
+        counts = {
+            part_name: cv2.countNonZero(segmentation[slice_y, slice_x])
+            for part_name, (slice_y, slice_x, _) in regions.items()
+            if part_name != 'torso'
+        }
+        torso_rows = regions['torso'][0]
+        torso_middle = segmentation[torso_rows, regions['left_arm'][1].stop:regions['right_arm'][1].start]
+        counts['torso'] = counts['left_arm'] + counts['right_arm'] + cv2.countNonZero(torso_middle)
         
         # Only include parts with significant pixel count
-        if np.sum(head_mask > 0) > 100:
-            parts['head'] = head_mask
-        if np.sum(torso_mask > 0) > 100:
-            parts['torso'] = torso_mask
-        if np.sum(left_arm_mask > 0) > 50:
-            parts['left_arm'] = left_arm_mask
-        if np.sum(right_arm_mask > 0) > 50:
-            parts['right_arm'] = right_arm_mask
-        if np.sum(left_leg_mask > 0) > 100:
-            parts['left_leg'] = left_leg_mask
-        if np.sum(right_leg_mask > 0) > 100:
-            parts['right_leg'] = right_leg_mask
+        for part_name, (slice_y, slice_x, threshold) in regions.items():
+            pixel_count = counts[part_name]
+            if pixel_count > threshold:
+                parts[part_name] = (slice_y, slice_x, segmentation[slice_y, slice_x], pixel_count)
         
         return parts
     
+    def _heuristic_regions(self, height: int, width: int) -> dict:
+        """Resolve _HEURISTIC_REGIONS to {part_name: (slice_y, slice_x, threshold)} for a frame size"""
+        regions = self._region_cache.get((height, width))
+        if regions is None:
+            regions = {
+                part_name: (
+                    slice(int(height * top), int(height * bottom)),
+                    slice(int(width * left), int(width * right)),
+                    threshold
+                )
+                for part_name, (top, bottom), (left, right), threshold in self._HEURISTIC_REGIONS
+            }
+            # Frames come in at a handful of working sizes; keep the cache small anyway
+            if len(self._region_cache) >= 32:
+                self._region_cache.clear()
+            self._region_cache[(height, width)] = regions
+        return regions
+    
     def _get_part_group(self, part_name: str) -> str:
         """Determine which group a body part belongs to"""
         for group_name, parts in self.BODY_PART_GROUPS.items():
@@ -295,15 +408,13 @@ class BodyPixProcessor:
             return False
         
         try:
-            # Create output directory structure
+            # Create output directory structure (once per output directory)
+            if not self._dirs_ready or self._last_output_dir != output_dir:
+                self._ensure_dirs(output_dir)
             output_path = Path(output_dir)
-            output_path.mkdir(parents=True, exist_ok=True)
-            
-            # Create subdirectories for each body part group
-            for group_name in self.BODY_PART_GROUPS.keys():
-                (output_path / group_name).mkdir(parents=True, exist_ok=True)
             
             base_name = Path(image_path).stem
+            original_size = result.get('original_size')
             saved_files = []
             
             # Save each body part to its respective folder
@@ -313,18 +424,29 @@ class BodyPixProcessor:
                 group = part_info['group']
                 
                 # Create colored mask for better visualization
-                colored_mask = self._create_colored_mask(part_mask, part_name)
+                colored_mask = self._create_colored_mask(
+                    part_mask, part_name,
+                    frame_size=part_info.get('frame_size'),
+                    offset=part_info.get('offset', (0, 0))
+                )
+                
+                # Segmentation ran at working resolution; scale back up for output
+                if original_size and colored_mask.shape[1::-1] != original_size:
+                    colored_mask = cv2.resize(colored_mask, original_size, interpolation=cv2.INTER_NEAREST)
                 
                 # Save to appropriate folder
                 output_file = output_path / group / f"{part_name}_{base_name}.png"
-                colored_mask.save(output_file)
+                cv2.imwrite(str(output_file), colored_mask, [cv2.IMWRITE_PNG_COMPRESSION, self.PNG_COMPRESSION])
                 
                 saved_files.append(str(output_file))
                 logger.info(f"💾 Saved {part_name} to: {output_file}")
             
             # Also save the full segmentation mask
             full_mask_path = output_path / f"{base_name}_full_segmentation.png"
-            cv2.imwrite(str(full_mask_path), result['segmentation'])
+            full_mask = result['segmentation']
+            if original_size and isinstance(full_mask, np.ndarray) and full_mask.shape[1::-1] != original_size:
+                full_mask = cv2.resize(full_mask, original_size, interpolation=cv2.INTER_NEAREST)
+            cv2.imwrite(str(full_mask_path), full_mask, [cv2.IMWRITE_PNG_COMPRESSION, self.PNG_COMPRESSION])
             saved_files.append(str(full_mask_path))
             
             logger.info(f"✅ Saved {len(saved_files)} files for {base_name}")
@@ -334,34 +456,62 @@ class BodyPixProcessor:
             logger.error(f"❌ Error saving segmentation: {e}")
             return False
     
-    def _create_colored_mask(self, mask: np.ndarray, part_name: str) -> Image.Image:
-        """Create a colored mask for a body part"""
-        # Generate a consistent color for this body part
+    def _ensure_dirs(self, output_dir: str):
+        """Create the output directory and one subdirectory per body part group"""
+        output_path = Path(output_dir)
+        output_path.mkdir(parents=True, exist_ok=True)
+        
+        for group_name in self.BODY_PART_GROUPS.keys():
+            (output_path / group_name).mkdir(parents=True, exist_ok=True)
+        
+        self._last_output_dir = output_dir
+        self._dirs_ready = True
+    
+    def _create_colored_mask(self, mask: np.ndarray, part_name: str,
+                             frame_size: tuple = None, offset: tuple = (0, 0)) -> np.ndarray:
+        """Create a colored BGR mask for a body part, ready for cv2.imwrite
+        
+        If frame_size (width, height) is given, mask is a cropped tile that gets
+        placed into a black frame of that size at offset (x, y).
+        """
+        # Generate a consistent color for this body part (reordered to BGR once)
         color = self._get_part_color(part_name)
+        color_arr = np.array(color[::-1], dtype=np.uint8).reshape(1, 1, 3)
         
-        # Create RGB image
-        colored_mask = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.uint8)
-        colored_mask[mask > 0] = color
+        # Create the image with a single broadcast instead of a boolean scatter
+        if frame_size is None or frame_size == (mask.shape[1], mask.shape[0]):
+            return np.where(mask[:, :, None] > 0, color_arr, np.uint8(0))
         
-        return Image.fromarray(colored_mask)
+        frame = np.zeros((frame_size[1], frame_size[0], 3), dtype=np.uint8)
+        x, y = offset
+        tile = frame[y:y + mask.shape[0], x:x + mask.shape[1]]
+        np.copyto(tile, color_arr, where=mask[:, :, None] > 0)
+        return frame
     
     def _get_part_color(self, part_name: str) -> tuple:
-        """Generate a consistent color for a body part"""
-        # Simple hash-based color generation
-        hash_val = hash(part_name) % 360
-        hue = hash_val / 360.0
-        
-        # Convert HSV to RGB
-        import colorsys
-        rgb = colorsys.hsv_to_rgb(hue, 0.8, 0.9)
-        return tuple(int(c * 255) for c in rgb)
+        """Look up the consistent color for a body part"""
+        color = self._PART_COLORS.get(part_name)
+        if color is None:
+            color = _hash_part_color(part_name)
+        return color
 
 class ImageHandler(FileSystemEventHandler):
     """Handles file system events for new images"""
     
-    def __init__(self, processing_queue: queue.Queue):
+    # In close-events mode, how long a created file may go without a close event before it
+    # is treated as moved in from outside the watch dir, and how many times to re-check it
+    CLOSE_GRACE = 1.0
+    CLOSE_GRACE_CHECKS = 10
+    
+    def __init__(self, processing_queue: queue.Queue, use_close_events: bool = False):
         self.processing_queue = processing_queue
         self.supported_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp'}
+        
+        # With inotify the close-after-write event says the file is complete, so created
+        # files wait for it instead of polling; files moved in from elsewhere never get one
+        self.use_close_events = use_close_events
+        self._awaiting_close = {}
+        self._awaiting_lock = threading.Lock()
     
     def on_created(self, event):
         if event.is_directory:
@@ -370,17 +520,109 @@ class ImageHandler(FileSystemEventHandler):
         file_path = event.src_path
         file_ext = Path(file_path).suffix.lower()
         
+        if file_ext not in self.supported_extensions:
+            return
+        
+        if self.use_close_events:
+            self._await_close(file_path, self.CLOSE_GRACE_CHECKS)
+            return
+        
+        # Wait for file to be fully written
+        if self._wait_until_stable(file_path):
+            self._enqueue(file_path)
+        else:
+            logger.warning(f"⚠️  Skipping incomplete image: {os.path.basename(file_path)}")
+    
+    def on_closed(self, event):
+        if event.is_directory or not self.use_close_events:
+            return
+        
+        file_path = event.src_path
+        file_ext = Path(file_path).suffix.lower()
+        
         if file_ext in self.supported_extensions:
-            # Wait for file to be fully written
-            time.sleep(0.5)
-            
+            self._stop_awaiting(file_path)
             if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                logger.info(f"📸 New image detected: {os.path.basename(file_path)}")
-                self.processing_queue.put(file_path)
+                self._enqueue(file_path)
+    
+    def on_moved(self, event):
+        # Renames into place (e.g. Syncthing's write-to-temp-then-rename) are complete files
+        if event.is_directory:
+            return
+        
+        self._stop_awaiting(event.src_path)
+        file_path = event.dest_path
+        file_ext = Path(file_path).suffix.lower()
+        
+        if file_ext in self.supported_extensions:
+            self._stop_awaiting(file_path)
+            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+                self._enqueue(file_path)
+    
+    def _enqueue(self, file_path: str):
+        """Queue a complete image for processing"""
+        logger.info(f"📸 New image detected: {os.path.basename(file_path)}")
+        self.processing_queue.put(file_path)
+    
+    def _await_close(self, file_path: str, checks_left: int):
+        """Give a created file CLOSE_GRACE seconds for its close event before checking it directly"""
+        timer = threading.Timer(self.CLOSE_GRACE, self._close_overdue, args=(file_path, checks_left))
+        timer.daemon = True
+        with self._awaiting_lock:
+            previous = self._awaiting_close.pop(file_path, None)
+            self._awaiting_close[file_path] = timer
+        if previous is not None:
+            previous.cancel()
+        timer.start()
+    
+    def _stop_awaiting(self, file_path: str):
+        """Forget a created file whose close (or rename) event has arrived"""
+        with self._awaiting_lock:
+            timer = self._awaiting_close.pop(file_path, None)
+        if timer is not None:
+            timer.cancel()
+    
+    def _close_overdue(self, file_path: str, checks_left: int):
+        """No close event came: a moved-in file is ready once its size holds steady"""
+        with self._awaiting_lock:
+            if self._awaiting_close.get(file_path) is not threading.current_thread():
+                return
+            del self._awaiting_close[file_path]
+        
+        if self._wait_until_stable(file_path):
+            self._enqueue(file_path)
+        elif checks_left > 1 and os.path.exists(file_path):
+            # Still being written: keep waiting for its close event
+            self._await_close(file_path, checks_left - 1)
+        else:
+            logger.warning(f"⚠️  Skipping incomplete image: {os.path.basename(file_path)}")
+    
+    def _wait_until_stable(self, file_path: str, interval: float = 0.05, retries: int = 1) -> bool:
+        """Check that a file is non-empty and its size has stopped changing"""
+        try:
+            size = os.path.getsize(file_path)
+            for _ in range(retries + 1):
+                time.sleep(interval)
+                new_size = os.path.getsize(file_path)
+                if new_size == size and size > 0:
+                    return True
+                size = new_size
+        except OSError:
+            # File vanished while we were looking at it
+            return False
+        
+        return False
 
 class BodyPixWatcher:
     """Main watcher class that coordinates file watching and processing"""
     
+    # Maximum number of queued images handed to the processor at once
+    MAX_BATCH = 8
+    
+    # Writer pool size, and how many results may wait on it before inference pauses
+    WRITER_WORKERS = 4
+    MAX_PENDING_WRITES = 4 * MAX_BATCH
+    
     def __init__(self, watch_dir: str, output_dir: str, model_path: str = None):
         self.watch_dir = watch_dir
         self.output_dir = output_dir
@@ -389,11 +631,24 @@ class BodyPixWatcher:
         # Queue for processing images in order
         self.processing_queue = queue.Queue(maxsize=100)
         
+        # Decoded (image_path, image_array, original_size) entries waiting for inference
+        self.decoded_queue = queue.Queue(maxsize=2 * self.MAX_BATCH)
+        
+        # Paths currently somewhere between dispatch and save
+        self._in_flight: Set[str] = set()
+        
+        # Save tasks submitted to the writer pool that haven't finished yet
+        self._write_futures: Set[Future] = set()
+        self._write_lock = threading.Lock()
+        
         # Components
         self.processor = None
         self.observer = None
         self.event_handler = None
-        self.processing_thread = None
+        self.dispatch_thread = None
+        self.inference_thread = None
+        self.decode_pool = None
+        self.writer_pool = None
         self.running = False
     
     def _initialize_processor(self):
@@ -405,42 +660,71 @@ class BodyPixWatcher:
             logger.error(f"❌ Failed to initialize processor: {e}")
             raise
     
-    def _processing_worker(self):
-        """Worker thread that processes images from the queue"""
-        logger.info("🔄 Processing worker started")
+    def _dispatch_worker(self):
+        """Worker thread that hands queued image paths to the decode pool"""
+        logger.info("🔄 Dispatch worker started")
         
         while self.running:
             try:
                 # Get image from queue (blocks for up to 1 second)
                 image_path = self.processing_queue.get(timeout=1.0)
                 
-                # Check if already processed
-                if image_path in self.processor.processed_files:
+                # Check if already processed (or already on its way through the pipeline)
+                if self.processor.is_processed(image_path) or image_path in self._in_flight:
                     logger.info(f"⏭️  Already processed: {os.path.basename(image_path)}")
                     self.processing_queue.task_done()
                     continue
                 
-                # Process the image
+                self._in_flight.add(image_path)
+                self.decode_pool.submit(self._decode_image, image_path)
+                
+            except queue.Empty:
+                # No items in queue, continue waiting
+                continue
+            except Exception as e:
+                logger.error(f"❌ Dispatch error: {e}")
+                continue
+        
+        logger.info("🛑 Dispatch worker stopped")
+    
+    def _decode_image(self, image_path: str):
+        """Decode pool task: load an image and pass it on to inference"""
+        try:
+            image_array, original_size = self.processor.load_image(image_path)
+        except Exception as e:
+            image_array, original_size = e, None
+        
+        # Blocks when inference falls behind, which throttles decoding
+        self.decoded_queue.put((image_path, image_array, original_size))
+    
+    def _inference_worker(self):
+        """Worker thread that runs batched inference on decoded images"""
+        logger.info("🔄 Inference worker started")
+        
+        while self.running:
+            try:
+                # Get decoded image (blocks for up to 1 second)
+                batch = [self.decoded_queue.get(timeout=1.0)]
+                
+                # Drain whatever else is already waiting, up to MAX_BATCH
+                while len(batch) < self.MAX_BATCH:
+                    try:
+                        batch.append(self.decoded_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                
+                # Process the batch
                 start_time = time.time()
-                result = self.processor.segment_image(image_path)
+                results = self.processor.segment_decoded(batch)
                 processing_time = time.time() - start_time
                 
-                if result['success']:
-                    # Save results
-                    save_success = self.processor.save_segmentation(
-                        image_path, self.output_dir, result
-                    )
-                    
-                    if save_success:
-                        logger.info(f"✅ Processed in {processing_time:.1f}s: {os.path.basename(image_path)}")
-                        self.processor.processed_files.add(image_path)
+                for (image_path, _, _), result in zip(batch, results):
+                    if result['success']:
+                        # Save results off the inference thread
+                        self._submit_write(image_path, result, processing_time, len(batch))
                     else:
-                        logger.error(f"❌ Failed to save: {os.path.basename(image_path)}")
-                else:
-                    logger.error(f"❌ Processing failed: {os.path.basename(image_path)} - {result.get('error', 'Unknown error')}")
-                
-                # Mark task as done
-                self.processing_queue.task_done()
+                        logger.error(f"❌ Processing failed: {os.path.basename(image_path)} - {result.get('error', 'Unknown error')}")
+                        self._finish(image_path)
                 
             except queue.Empty:
                 # No items in queue, continue waiting
@@ -449,7 +733,46 @@ class BodyPixWatcher:
                 logger.error(f"❌ Processing error: {e}")
                 continue
         
-        logger.info("🛑 Processing worker stopped")
+        logger.info("🛑 Inference worker stopped")
+    
+    def _submit_write(self, image_path: str, result: dict, processing_time: float, batch_size: int):
+        """Queue a result on the writer pool, waiting if too many saves are pending"""
+        with self._write_lock:
+            pending = set(self._write_futures)
+        if len(pending) >= self.MAX_PENDING_WRITES:
+            wait(pending, return_when=FIRST_COMPLETED)
+        
+        future = self.writer_pool.submit(self._write_result, image_path, result, processing_time, batch_size)
+        with self._write_lock:
+            self._write_futures.add(future)
+        future.add_done_callback(self._write_done)
+    
+    def _write_done(self, future: Future):
+        """Forget a finished save task and report anything it raised"""
+        with self._write_lock:
+            self._write_futures.discard(future)
+        if future.exception() is not None:
+            logger.error(f"❌ Writer error: {future.exception()}")
+    
+    def _write_result(self, image_path: str, result: dict, processing_time: float, batch_size: int):
+        """Writer pool task: save one segmentation result"""
+        try:
+            save_success = self.processor.save_segmentation(
+                image_path, self.output_dir, result
+            )
+            
+            if save_success:
+                logger.info(f"✅ Processed in {processing_time:.1f}s (batch of {batch_size}): {os.path.basename(image_path)}")
+                self.processor.mark_processed(image_path)
+            else:
+                logger.error(f"❌ Failed to save: {os.path.basename(image_path)}")
+        finally:
+            self._finish(image_path)
+    
+    def _finish(self, image_path: str):
+        """Mark an image as fully handled by the pipeline"""
+        self._in_flight.discard(image_path)
+        self.processing_queue.task_done()
     
     def _setup_file_watcher(self):
         """Setup the file system watcher"""
@@ -457,12 +780,30 @@ class BodyPixWatcher:
             logger.error(f"❌ Watch directory not found: {self.watch_dir}")
             raise FileNotFoundError(f"Watch directory not found: {self.watch_dir}")
         
-        self.event_handler = ImageHandler(self.processing_queue)
         self.observer = Observer()
+        self.event_handler = ImageHandler(
+            self.processing_queue,
+            use_close_events=type(self.observer).__name__ == 'InotifyObserver'
+        )
         self.observer.schedule(self.event_handler, self.watch_dir, recursive=False)
         
         logger.info(f"👀 Watching directory: {self.watch_dir}")
     
+    def _enqueue_existing_images(self):
+        """Queue images already present in the watch directory"""
+        # scandir hands back file type info with each entry, so no extra stat calls
+        with os.scandir(self.watch_dir) as entries:
+            image_paths = sorted(
+                entry.path for entry in entries
+                if entry.is_file(follow_symlinks=False)
+                and Path(entry.name).suffix.lower() in self.event_handler.supported_extensions
+            )
+        
+        if image_paths:
+            logger.info(f"📂 Found {len(image_paths)} existing images")
+        for image_path in image_paths:
+            self.processing_queue.put(image_path)
+    
     def start(self):
         """Start the watcher"""
         try:
@@ -474,10 +815,17 @@ class BodyPixWatcher:
             self._initialize_processor()
             self._setup_file_watcher()
             
-            # Start processing thread
+            # Start processing pipeline: decode pool -> inference thread -> writer pool
             self.running = True
-            self.processing_thread = threading.Thread(target=self._processing_worker, daemon=True)
-            self.processing_thread.start()
+            self.decode_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='decode')
+            self.writer_pool = ThreadPoolExecutor(max_workers=self.WRITER_WORKERS, thread_name_prefix='writer')
+            self.inference_thread = threading.Thread(target=self._inference_worker, daemon=True)
+            self.inference_thread.start()
+            self.dispatch_thread = threading.Thread(target=self._dispatch_worker, daemon=True)
+            self.dispatch_thread.start()
+            
+            # Pick up images that were already there before we started watching
+            self._enqueue_existing_images()
             
             # Start file watcher
             self.observer.start()
@@ -499,23 +847,34 @@ class BodyPixWatcher:
     def stop(self):
         """Stop the watcher"""
         logger.info("🛑 Stopping BodyPix Watcher...")
-        self.running = False
         
         # Stop file watcher
         if self.observer:
             self.observer.stop()
             self.observer.join()
         
-        # Wait for processing queue to empty
-        if self.processing_queue:
+        # Wait for processing queue to empty (needs the pipeline still running)
+        if self.processing_queue and self.running:
             try:
                 self.processing_queue.join()
             except:
                 pass
         
-        # Wait for processing thread to finish
-        if self.processing_thread and self.processing_thread.is_alive():
-            self.processing_thread.join(timeout=5.0)
+        self.running = False
+        
+        # Wait for pipeline threads to finish
+        for thread in (self.dispatch_thread, self.inference_thread):
+            if thread and thread.is_alive():
+                thread.join(timeout=5.0)
+        
+        # Let pending saves land on disk before tearing the pools down
+        with self._write_lock:
+            pending = set(self._write_futures)
+        wait(pending, timeout=30.0)
+        
+        for pool in (self.decode_pool, self.writer_pool):
+            if pool:
+                pool.shutdown(wait=True)
         
         logger.info("👋 BodyPix Watcher stopped")
 
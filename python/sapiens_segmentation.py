@@ -6,9 +6,14 @@ Uses Facebook Research Sapiens Lite for body-part segmentation
 
 import sys
 import os
+import colorsys
+import hashlib
 import json
 import argparse
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 import numpy as np
@@ -18,6 +23,11 @@ import torch.nn.functional as F
 from torchvision import transforms
 import cv2
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Add Sapiens Lite to path
 SAPIENS_LITE_PATH = Path(__file__).parent / 'sapiens' / 'lite'
 if SAPIENS_LITE_PATH.exists():
@@ -71,6 +81,12 @@ SAPIENS_BODY_PARTS = {
     36: 'right_foot'
 }
 
+# Network input resolution (height, width) and ImageNet statistics used by the
+# Sapiens segmentation checkpoints
+SAPIENS_INPUT_SIZE = (1024, 768)
+SAPIENS_MEAN = [123.675, 116.28, 103.53]
+SAPIENS_STD = [58.395, 57.12, 57.375]
+
 # Group body parts for organized output - SPLIT ARMS INTO LEFT AND RIGHT
 BODY_PART_GROUPS = {
     'head': ['hair', 'face', 'left_eye', 'right_eye', 'nose', 'mouth', 'upper_lip', 'lower_lip', 'teeth', 'tongue', 'left_ear', 'right_ear', 'neck'],
@@ -81,7 +97,26 @@ BODY_PART_GROUPS = {
     'right_leg': ['right_hip', 'right_thigh', 'right_knee', 'right_shin', 'right_ankle', 'right_foot']
 }
 
+# Inverse of BODY_PART_GROUPS for constant-time group lookup
+PART_TO_GROUP = {part: group for group, parts in BODY_PART_GROUPS.items() for part in parts}
+
+def _part_color(part_name: str) -> Tuple[int, int, int]:
+    """Generate a consistent color for a body part, stable across runs"""
+    hue = int.from_bytes(hashlib.md5(part_name.encode()).digest()[:2], 'big') % 360 / 360.0
+    rgb = colorsys.hsv_to_rgb(hue, 0.8, 0.9)
+    return tuple(int(c * 255) for c in rgb)
+
+# RGB color per label id, covering every value a uint8 mask can hold
+PART_COLORS = np.zeros((256, 3), dtype=np.uint8)
+for _label in range(1, 256):
+    PART_COLORS[_label] = _part_color(SAPIENS_BODY_PARTS.get(_label, f'unknown_{_label}'))
+
 class SapiensSegmentationService:
+    # PNG encoding in cv2 releases the GIL, so part masks are written in parallel
+    SAVE_WORKERS = 4
+    # Pinned staging buffers start out large enough for an image of this (height, width)
+    PINNED_IMAGE_SIZE = (2160, 3840)
+    
     def __init__(self, model_path: str = None, device: str = 'auto'):
         """
         Initialize the Sapiens segmentation service
@@ -93,6 +128,18 @@ class SapiensSegmentationService:
         self.device = self._get_device(device)
         self.model = None
         self.model_path = model_path or str(SAPIENS_LITE_PATH / 'sapiens_lite.pth')
+        self._save_pool = ThreadPoolExecutor(max_workers=self.SAVE_WORKERS, thread_name_prefix='sapiens-save')
+        self._scratch = threading.local()
+        self._transform = self._build_transform()
+        self._pinned = {}
+        self._preproc_stream = None
+        self._ready_dirs = set()
+        
+        # CUDA graphs of the backbone keyed by batched input shape:
+        # shape -> (graph, static_in, static_out)
+        self._graphs = {}
+        self._use_graphs = self.device == 'cuda'
+        
         self._load_model()
     
     def _get_device(self, device: str) -> str:
@@ -116,6 +163,20 @@ class SapiensSegmentationService:
             
             # Initialize Sapiens Lite
             self.model = SapiensLite(model_path=self.model_path, device=self.device)
+            
+            # Inference only: no dropout/batch-norm updates, NHWC convs
+            network = self._network()
+            if network is not None:
+                network.eval()
+                network.to(memory_format=torch.channels_last)
+                if not self._compile_network(network):
+                    self.model.model = self._optimize_network(network)
+                    self._warmup()
+            
+            # Side stream for uploads/normalization issued by preprocess()
+            if self.device == 'cuda':
+                self._preproc_stream = torch.cuda.Stream()
+            
             print(f"✅ Sapiens Lite model loaded successfully on {self.device}")
             
         except Exception as e:
@@ -123,6 +184,232 @@ class SapiensSegmentationService:
             print("💡 Make sure you've run setup_sapiens.sh to download the model")
             raise
     
+    def _compile_network(self, network: torch.nn.Module) -> bool:
+        """
+        Compile the backbone with torch.compile on CUDA
+        
+        'reduce-overhead' captures CUDA graphs itself, so the manual graph
+        path is turned off when this succeeds. Returns False (leaving the
+        backbone untouched) where torch.compile is unavailable or fails.
+        """
+        if self.device != 'cuda' or not hasattr(torch, 'compile'):
+            return False
+        
+        try:
+            self.model.model = torch.compile(network, mode='reduce-overhead', fullgraph=False, dynamic=False)
+            # Compilation is lazy; warm up so Inductor specializes before the first image
+            self._warmup()
+            self._use_graphs = False
+            print("⚡ Backbone compiled with torch.compile (reduce-overhead)")
+            return True
+        except Exception as e:
+            print(f"⚠️ torch.compile unavailable, falling back to TorchScript: {e}")
+            self.model.model = network
+            return False
+    
+    def _optimize_network(self, network: torch.nn.Module) -> torch.nn.Module:
+        """Script and freeze the backbone for inference, keeping it eager on failure"""
+        try:
+            if not isinstance(network, torch.jit.ScriptModule):
+                try:
+                    network = torch.jit.script(network)
+                except Exception:
+                    # Outputs such as named tuples can defeat scripting; tracing
+                    # only needs a representative input
+                    example = self._warmup_input()
+                    with torch.inference_mode():
+                        network = torch.jit.trace(network, example, strict=False)
+            
+            network = torch.jit.optimize_for_inference(network)
+            print("⚡ Backbone scripted and optimized for inference")
+        except Exception as e:
+            print(f"⚠️ TorchScript optimization skipped: {e}")
+        
+        return network
+    
+    def _warmup_input(self) -> torch.Tensor:
+        """Zero tensor at the network input resolution"""
+        return torch.zeros(1, 3, *SAPIENS_INPUT_SIZE, device=self.device).contiguous(
+            memory_format=torch.channels_last)
+    
+    def _warmup(self, iterations: int = 2):
+        """Run a few forward passes so JIT profiling is done before the first real image"""
+        network = self._network()
+        example = self._warmup_input()
+        with self._infer_ctx():
+            for _ in range(iterations):
+                network(example)
+    
+    @contextmanager
+    def _infer_ctx(self):
+        """Disable autograd for the forward pass and use FP16 autocast on CUDA"""
+        with torch.inference_mode():
+            if self.device == 'cuda':
+                # The autocast weight cache must stay off for CUDA graph capture
+                with torch.autocast(device_type='cuda', dtype=torch.float16, cache_enabled=False):
+                    yield
+            else:
+                yield
+    
+    def _network(self) -> Optional[torch.nn.Module]:
+        """Return the raw backbone wrapped by SapiensLite, if exposed"""
+        network = getattr(self.model, 'model', None)
+        return network if isinstance(network, torch.nn.Module) else None
+    
+    def _run_model(self, image: np.ndarray):
+        """
+        Run the model on an RGB image and return its raw segmentation output
+        
+        Every device goes through the same _build_transform() preprocessing
+        and backbone call; SapiensLite's own pipeline is only used when it
+        does not expose its backbone.
+        """
+        network = self._network()
+        if network is not None:
+            return self._segment_tensors([image], network)[0]
+        
+        with self._infer_ctx():
+            return self.model.segment_person_parts(Image.fromarray(image))
+    
+    def _build_transform(self) -> torch.nn.Module:
+        """Resize + normalize pipeline applied on-device to uint8 image tensors"""
+        transform = torch.nn.Sequential(
+            transforms.Resize(SAPIENS_INPUT_SIZE, antialias=True),
+            transforms.ConvertImageDtype(torch.float32),
+            transforms.Normalize([m / 255.0 for m in SAPIENS_MEAN], [s / 255.0 for s in SAPIENS_STD])
+        )
+        try:
+            return torch.jit.script(transform)
+        except Exception:
+            return transform
+    
+    def _upload(self, image: np.ndarray, slot: int = 0) -> torch.Tensor:
+        """Copy an RGB image to the device as a (1, 3, H, W) uint8 tensor"""
+        if self.device != 'cuda':
+            return torch.from_numpy(image).to(self.device).permute(2, 0, 1).unsqueeze(0)
+        
+        # Stage through page-locked memory so the H2D copy can run asynchronously;
+        # each image of a batch gets its own slot so pending copies are not overwritten
+        staged = self._pinned_view(slot, image.shape)
+        staged.numpy()[...] = image
+        return staged.to(self.device, non_blocking=True).permute(2, 0, 1).unsqueeze(0)
+    
+    def _pinned_view(self, slot, shape: Tuple[int, ...]) -> torch.Tensor:
+        """Return a view of shape over the slot's persistent pinned buffer, growing it if needed"""
+        size = int(np.prod(shape))
+        buffer = self._pinned.get(slot)
+        if buffer is None or buffer.numel() < size:
+            capacity = max(size, self.PINNED_IMAGE_SIZE[0] * self.PINNED_IMAGE_SIZE[1] * 3)
+            buffer = self._pinned[slot] = torch.empty(capacity, dtype=torch.uint8, pin_memory=True)
+        return buffer[:size].view(shape)
+    
+    def _preprocess(self, image: np.ndarray, slot: int = 0) -> torch.Tensor:
+        """Upload an RGB image and resize/normalize it to the network input"""
+        return self._transform(self._upload(image, slot))
+    
+    def preprocess(self, image: np.ndarray) -> Tuple[Optional[torch.Tensor], Optional[torch.cuda.Event]]:
+        """
+        Upload and normalize an image ahead of segment_images()
+        
+        Runs on a side CUDA stream so it can be called from worker threads
+        while the backbone is busy. Returns the network input and an event
+        marking its completion, or (None, None) when the direct CUDA path
+        is not in use.
+        """
+        if self._preproc_stream is None or self._network() is None:
+            return None, None
+        
+        with torch.cuda.stream(self._preproc_stream):
+            tensor = self._preprocess(image, slot=('preprocess', threading.get_ident()))
+            event = torch.cuda.Event()
+            event.record(self._preproc_stream)
+        
+        # This thread's pinned staging buffer is reused for its next image
+        event.synchronize()
+        return tensor, event
+    
+    def _segment_tensors(self, images: List[np.ndarray], network: torch.nn.Module,
+                         prepared: Optional[List[Tuple[torch.Tensor, torch.cuda.Event]]] = None) -> List[torch.Tensor]:
+        """Segment a batch through the backbone directly, replaying a CUDA graph when possible"""
+        if prepared is None:
+            x = torch.cat([self._preprocess(image, slot) for slot, image in enumerate(images)])
+        else:
+            # Inputs were produced on the preprocess stream
+            current = torch.cuda.current_stream()
+            for tensor, event in prepared:
+                current.wait_event(event)
+                tensor.record_stream(current)
+            x = torch.cat([tensor for tensor, _ in prepared])
+        x = x.contiguous(memory_format=torch.channels_last)
+        
+        with self._infer_ctx():
+            logits = self._forward(network, x)
+            masks = []
+            for i, image in enumerate(images):
+                upsampled = F.interpolate(logits[i:i + 1].float(), size=image.shape[:2],
+                                          mode='bilinear', align_corners=False)
+                masks.append(upsampled.argmax(1)[0].to(torch.uint8))
+            return masks
+    
+    def _forward(self, network: torch.nn.Module, x: torch.Tensor) -> torch.Tensor:
+        """Backbone forward pass, through the captured CUDA graph for its input shape"""
+        if self._use_graphs and x.shape not in self._graphs:
+            try:
+                self._capture_graph(network, x)
+            except torch.cuda.OutOfMemoryError:
+                raise
+            except Exception as e:
+                print(f"⚠️ CUDA graph capture failed, running eagerly: {e}")
+                self._graphs.clear()
+                self._use_graphs = False
+        
+        if x.shape not in self._graphs:
+            return self._logits(network(x))
+        
+        graph, static_in, static_out = self._graphs[x.shape]
+        static_in.copy_(x, non_blocking=True)
+        graph.replay()
+        return static_out
+    
+    def _capture_graph(self, network: torch.nn.Module, x: torch.Tensor):
+        """Warm up on a side stream, then capture one forward pass as a CUDA graph"""
+        static_in = x.clone()
+        
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                network(static_in)
+        torch.cuda.current_stream().wait_stream(stream)
+        
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_out = self._logits(network(static_in))
+        
+        self._graphs[x.shape] = (graph, static_in, static_out)
+        print(f"⚡ Captured CUDA graph for input {tuple(x.shape)}")
+    
+    @staticmethod
+    def _logits(output) -> torch.Tensor:
+        """Pull the logits tensor out of a backbone output"""
+        if isinstance(output, (tuple, list)):
+            return output[0]
+        if isinstance(output, dict):
+            return output.get('logits', next(iter(output.values())))
+        return output
+    
+    def load_image(self, image_path: str) -> np.ndarray:
+        """
+        Decode an image file into an RGB array
+        
+        cv2 decodes through libjpeg-turbo and releases the GIL, so this is
+        safe to call from a prefetch thread while the model is busy.
+        """
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Could not decode image: {image_path}")
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    
     def segment_image(self, image_path: str) -> Dict:
         """
         Perform body-part segmentation on an image
@@ -136,49 +423,40 @@ class SapiensSegmentationService:
         start_time = time.time()
         
         try:
-            # Load image
-            image = Image.open(image_path).convert('RGB')
-            original_size = image.size
+            image = self.load_image(image_path)
+        except Exception as e:
+            print(f"❌ Error during segmentation: {e}")
+            return {
+                'success': False,
+                'error': str(e),
+                'processing_time': time.time() - start_time
+            }
+        
+        return self.segment_decoded(image, start_time)
+    
+    def segment_decoded(self, image: np.ndarray, start_time: Optional[float] = None) -> Dict:
+        """
+        Perform body-part segmentation on an already decoded RGB image
+        
+        Args:
+            image: RGB array as returned by load_image()
+            start_time: Timestamp to measure processing time from
+            
+        Returns:
+            Dictionary containing segmentation results
+        """
+        if start_time is None:
+            start_time = time.time()
+        
+        try:
+            original_size = (image.shape[1], image.shape[0])
             
             print(f"📸 Processing image: {original_size[0]}x{original_size[1]}")
             
             # Run segmentation using Sapiens Lite
-            segmentation_result = self.model.segment_person_parts(image)
-            
-            # Extract segmentation mask
-            if isinstance(segmentation_result, dict):
-                segmentation_mask = segmentation_result.get('segmentation', segmentation_result.get('mask'))
-            else:
-                segmentation_mask = segmentation_result
-            
-            if segmentation_mask is None:
-                raise ValueError("No segmentation mask returned from model")
+            segmentation_result = self._run_model(image)
             
-            # Convert to numpy if needed
-            if torch.is_tensor(segmentation_mask):
-                segmentation_mask = segmentation_mask.cpu().numpy()
-            
-            # Extract individual body parts
-            body_parts = self._extract_body_parts(segmentation_mask, original_size)
-            
-            processing_time = time.time() - start_time
-            
-            result = {
-                'success': True,
-                'original_size': original_size,
-                'processing_time': processing_time,
-                'body_parts': body_parts,
-                'total_parts_found': len(body_parts),
-                'model_info': {
-                    'model': 'Sapiens Lite',
-                    'device': self.device
-                }
-            }
-            
-            print(f"✅ Segmentation completed in {processing_time:.2f}s")
-            print(f"📊 Found {len(body_parts)} body parts")
-            
-            return result
+            return self._build_result(segmentation_result, original_size, start_time)
             
         except Exception as e:
             print(f"❌ Error during segmentation: {e}")
@@ -188,51 +466,145 @@ class SapiensSegmentationService:
                 'processing_time': time.time() - start_time
             }
     
+    def segment_images(self, images: List[np.ndarray], start_time: Optional[float] = None,
+                       prepared: Optional[List[Tuple[Optional[torch.Tensor], Optional[torch.cuda.Event]]]] = None) -> List[Dict]:
+        """
+        Perform body-part segmentation on several decoded RGB images
+        
+        The images share one batched forward pass; if the batch does not fit
+        in memory, or the backbone is not exposed, they are segmented one by one.
+        
+        Args:
+            images: RGB arrays as returned by load_image()
+            start_time: Timestamp to measure processing time from
+            prepared: Per-image results of preprocess(), if already run
+            
+        Returns:
+            One result dictionary per image, in order
+        """
+        if start_time is None:
+            start_time = time.time()
+        
+        if prepared is not None and any(tensor is None for tensor, _ in prepared):
+            prepared = None
+        
+        network = self._network()
+        if (len(images) > 1 or prepared is not None) and network is not None:
+            try:
+                print(f"📸 Processing batch of {len(images)} images")
+                masks = self._segment_tensors(images, network, prepared)
+                return [
+                    self._build_result(mask, (image.shape[1], image.shape[0]), start_time)
+                    for image, mask in zip(images, masks)
+                ]
+            except torch.cuda.OutOfMemoryError:
+                print(f"⚠️ Out of memory on a batch of {len(images)}, falling back to one image at a time")
+                torch.cuda.empty_cache()
+            except Exception as e:
+                print(f"⚠️ Batched segmentation failed, falling back to one image at a time: {e}")
+        
+        return [self.segment_decoded(image, start_time) for image in images]
+    
+    def _build_result(self, segmentation_result, original_size: Tuple[int, int], start_time: float) -> Dict:
+        """Turn raw model output into the segmentation result dictionary"""
+        # Extract segmentation mask
+        if isinstance(segmentation_result, dict):
+            segmentation_mask = segmentation_result.get('segmentation', segmentation_result.get('mask'))
+        else:
+            segmentation_mask = segmentation_result
+        
+        if segmentation_mask is None:
+            raise ValueError("No segmentation mask returned from model")
+        
+        # Convert to numpy if needed
+        if torch.is_tensor(segmentation_mask):
+            segmentation_mask = self._mask_to_host(segmentation_mask)
+        
+        # Extract individual body parts
+        body_parts = self._extract_body_parts(segmentation_mask, original_size)
+        
+        processing_time = time.time() - start_time
+        
+        result = {
+            'success': True,
+            'original_size': original_size,
+            'processing_time': processing_time,
+            'body_parts': body_parts,
+            'total_parts_found': len(body_parts),
+            'model_info': {
+                'model': 'Sapiens Lite',
+                'device': self.device
+            },
+            # Raw label mask for save_segmentation_masks(); not JSON serializable
+            '_mask': segmentation_mask
+        }
+        
+        print(f"✅ Segmentation completed in {processing_time:.2f}s")
+        print(f"📊 Found {len(body_parts)} body parts")
+        
+        return result
+    
+    def _mask_to_host(self, mask: torch.Tensor) -> np.ndarray:
+        """Reduce a mask to uint8 labels on its device, then copy only that to the host"""
+        if mask.is_floating_point() and mask.dim() >= 3:
+            # Per-class logits: (C, H, W) or (1, C, H, W)
+            mask = mask.argmax(dim=-3)
+        mask = mask.squeeze()
+        if mask.dtype != torch.uint8 and len(SAPIENS_BODY_PARTS) <= 256:
+            mask = mask.to(torch.uint8)
+        
+        if mask.device.type != 'cuda':
+            return mask.cpu().numpy()
+        
+        # Pinned destination lets the copy run as a DMA transfer; the caching
+        # host allocator keeps these allocations cheap
+        host = torch.empty(mask.shape, dtype=mask.dtype, pin_memory=True)
+        host.copy_(mask, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+        return host.numpy()
+    
     def _extract_body_parts(self, segmentation_mask: np.ndarray, original_size: Tuple[int, int]) -> List[Dict]:
         """Extract individual body parts from segmentation mask"""
         body_parts = []
         
-        # Get unique labels in the segmentation
-        unique_labels = np.unique(segmentation_mask)
+        # Count every label in one linear pass; per-part masks are only
+        # materialized in save_segmentation_masks()
+        flat = segmentation_mask.ravel().astype(np.intp, copy=False)
+        counts = np.bincount(flat, minlength=len(SAPIENS_BODY_PARTS))
         
-        for label in unique_labels:
-            if label == 0:  # Skip background
+        for label, pixel_count in enumerate(counts):
+            if label == 0 or pixel_count == 0:  # Skip background and absent parts
                 continue
-                
-            part_name = SAPIENS_BODY_PARTS.get(label, f'unknown_{label}')
             
-            # Create mask for this body part
-            part_mask = (segmentation_mask == label).astype(np.uint8) * 255
-            
-            # Count pixels
-            pixel_count = np.sum(part_mask > 0)
+            part_name = SAPIENS_BODY_PARTS.get(label, f'unknown_{label}')
             
-            if pixel_count > 0:  # Only include parts with pixels
-                body_parts.append({
-                    'name': part_name,
-                    'label_id': int(label),
-                    'pixel_count': int(pixel_count),
-                    'mask_size': original_size,
-                    'group': self._get_part_group(part_name)
-                })
+            body_parts.append({
+                'name': part_name,
+                'label_id': label,
+                'pixel_count': int(pixel_count),
+                'mask_size': original_size,
+                'group': self._get_part_group(part_name)
+            })
         
         return body_parts
     
     def _get_part_group(self, part_name: str) -> str:
         """Determine which group a body part belongs to"""
-        for group_name, parts in BODY_PART_GROUPS.items():
-            if part_name in parts:
-                return group_name
-        return 'other'
+        return PART_TO_GROUP.get(part_name, 'other')
     
-    def save_segmentation_masks(self, image_path: str, output_dir: str, segmentation_result: Dict) -> Dict:
+    def save_segmentation_masks(self, image_path: str, output_dir: str, segmentation_result: Dict,
+                                emit_per_part: bool = False) -> Dict:
         """
-        Save individual body part masks as images
+        Save the segmentation as a palettized label map, plus per-part masks if asked
+        
+        The label map is a single mode 'P' PNG whose pixel values are label
+        ids, colored with PART_COLORS; any part's mask is `labels == label_id`.
         
         Args:
             image_path: Path to the original image
             output_dir: Directory to save masks
             segmentation_result: Result from segment_image()
+            emit_per_part: Also write one colored RGB PNG per body part
             
         Returns:
             Dictionary with save results
@@ -241,43 +613,31 @@ class SapiensSegmentationService:
             return {'success': False, 'error': 'Segmentation failed'}
         
         try:
-            # Create output directories
-            output_path = Path(output_dir)
-            for group in BODY_PART_GROUPS.keys():
-                (output_path / group).mkdir(parents=True, exist_ok=True)
-            
-            # Load original image and get full segmentation
-            image = Image.open(image_path).convert('RGB')
-            segmentation_result_full = self.model.segment_person_parts(image)
+            output_path = self.ensure_output_dirs(output_dir)
             
-            # Extract segmentation mask
-            if isinstance(segmentation_result_full, dict):
-                segmentation_mask = segmentation_result_full.get('segmentation', segmentation_result_full.get('mask'))
-            else:
-                segmentation_mask = segmentation_result_full
-            
-            if torch.is_tensor(segmentation_mask):
-                segmentation_mask = segmentation_mask.cpu().numpy()
+            # Reuse the label mask from segment_image() instead of a second forward pass
+            segmentation_mask = segmentation_result['_mask']
             
             saved_files = []
             base_filename = Path(image_path).stem
             
-            # Save each body part
-            for part_info in segmentation_result['body_parts']:
-                part_name = part_info['name']
-                label_id = part_info['label_id']
-                group = part_info['group']
-                
-                # Create mask for this part
-                part_mask = (segmentation_mask == label_id).astype(np.uint8) * 255
-                
-                # Create colored mask
-                colored_mask = self._create_colored_mask(part_mask, part_name)
-                
-                # Save mask
-                output_file = output_path / group / f"{part_name}_{base_filename}.png"
-                colored_mask.save(output_file)
-                
+            output_file = output_path / f"{base_filename}_labels.png"
+            self._save_label_map(segmentation_mask, output_file)
+            saved_files.append(str(output_file))
+            print(f"💾 Saved label map to: {output_file}")
+            
+            # Colorize and encode each body part on the save pool
+            futures = []
+            if emit_per_part:
+                for part_info in segmentation_result['body_parts']:
+                    part_name = part_info['name']
+                    output_file = output_path / part_info['group'] / f"{part_name}_{base_filename}.png"
+                    futures.append((part_name, output_file, self._save_pool.submit(
+                        self._save_part_mask, segmentation_mask, part_info['label_id'], output_file
+                    )))
+            
+            for part_name, output_file, future in futures:
+                future.result()
                 saved_files.append(str(output_file))
                 print(f"💾 Saved {part_name} to: {output_file}")
             
@@ -291,27 +651,49 @@ class SapiensSegmentationService:
             print(f"❌ Error saving masks: {e}")
             return {'success': False, 'error': str(e)}
     
-    def _create_colored_mask(self, mask: np.ndarray, part_name: str) -> Image.Image:
-        """Create a colored mask for a body part"""
-        # Generate a consistent color for this body part
-        color = self._get_part_color(part_name)
+    def ensure_output_dirs(self, output_dir: str) -> Path:
+        """Create the per-group output directories once per output_dir"""
+        output_path = Path(output_dir)
+        if output_path not in self._ready_dirs:
+            for group in BODY_PART_GROUPS.keys():
+                (output_path / group).mkdir(parents=True, exist_ok=True)
+            self._ready_dirs.add(output_path)
+        return output_path
+    
+    def _save_label_map(self, segmentation_mask: np.ndarray, output_file: Path):
+        """Write the whole label mask as one palettized PNG"""
+        # putpalette() turns the 'L' image into mode 'P' without copying pixels
+        label_map = Image.fromarray(segmentation_mask.astype(np.uint8, copy=False))
+        label_map.putpalette(PART_COLORS.tobytes())
+        label_map.save(output_file, optimize=False, compress_level=1)
+    
+    def _save_part_mask(self, segmentation_mask: np.ndarray, label_id: int, output_file: Path):
+        """Colorize one body part and write it as PNG (runs on the save pool)"""
+        colored_mask = self._create_colored_mask(segmentation_mask == label_id, label_id)
+        if not cv2.imwrite(str(output_file), colored_mask):
+            raise IOError(f"Could not write {output_file}")
+    
+    def _create_colored_mask(self, mask: np.ndarray, label_id: int) -> np.ndarray:
+        """
+        Create a colored BGR mask for a body part
         
-        # Create RGB image
-        colored_mask = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.uint8)
-        colored_mask[mask > 0] = color
+        The result lives in a per-thread scratch buffer that is reused by the
+        next call on the same thread.
+        """
+        scratch = getattr(self._scratch, 'bgr', None)
+        if scratch is None or scratch.shape[:2] != mask.shape:
+            scratch = self._scratch.bgr = np.empty((*mask.shape, 3), dtype=np.uint8)
         
-        return Image.fromarray(colored_mask)
-    
-    def _get_part_color(self, part_name: str) -> Tuple[int, int, int]:
-        """Generate a consistent color for a body part"""
-        # Simple hash-based color generation
-        hash_val = hash(part_name) % 360
-        hue = hash_val / 360.0
+        # Broadcast the boolean mask against the part color in a single pass
+        np.multiply(mask[..., None], PART_COLORS[label_id][::-1], out=scratch)
         
-        # Convert HSV to RGB
-        import colorsys
-        rgb = colorsys.hsv_to_rgb(hue, 0.8, 0.9)
-        return tuple(int(c * 255) for c in rgb)
+        return scratch
+
+def _dumps(obj) -> str:
+    """Serialize to compact single-line JSON, through orjson when installed"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'))
 
 def main():
     parser = argparse.ArgumentParser(description='Sapiens Body-Part Segmentation')
@@ -320,7 +702,9 @@ def main():
     parser.add_argument('--model-path', help='Path to Sapiens Lite model')
     parser.add_argument('--device', default='auto', choices=['auto', 'cpu', 'cuda', 'mps'],
                        help='Device to run inference on')
-    parser.add_argument('--save-masks', action='store_true', help='Save individual body part masks')
+    parser.add_argument('--save-masks', action='store_true', help='Save the segmentation label map')
+    parser.add_argument('--emit-per-part', action='store_true',
+                       help='With --save-masks, also write one colored PNG per body part')
     
     args = parser.parse_args()
     
@@ -357,16 +741,23 @@ def main():
             # Save masks if requested
             if args.save_masks:
                 print(f"\n Saving masks to: {args.output_dir}")
-                save_result = service.save_segmentation_masks(args.image_path, args.output_dir, result)
+                save_result = service.save_segmentation_masks(
+                    args.image_path, args.output_dir, result, emit_per_part=args.emit_per_part
+                )
                 
-                if save_result['success']:
-                    print(f"✅ Saved {save_result['total_saved']} body part masks")
+                if save_result['success'] and args.emit_per_part:
+                    print(f"✅ Saved label map and {save_result['total_saved'] - 1} body part masks")
+                elif save_result['success']:
+                    print(f"✅ Saved label map")
                 else:
                     print(f"❌ Error saving masks: {save_result['error']}")
             
             # Output JSON for Electron app
+            result.pop('_mask', None)
             print("\n📤 JSON Output:")
-            print(json.dumps(result, indent=2))
+            sys.stdout.write(_dumps(result))
+            sys.stdout.write('\n')
+            sys.stdout.flush()
             
         else:
             print(f"❌ Segmentation failed: {result['error']}")
@@ -10,11 +10,20 @@ import queue
 import threading
 import logging
 import platform
+from collections import OrderedDict
 from pathlib import Path
+from typing import List, Tuple
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from sapiens_segmentation import SapiensSegmentationService
 
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+SUPPORTED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
+
 def setup_logging():
     log_dir = Path(__file__).parent / 'logs'
     log_dir.mkdir(exist_ok=True)
@@ -33,12 +42,22 @@ def setup_logging():
 logger = setup_logging()
 
 class ImageProcessor:
-    def __init__(self, output_dir: str, model_size: str = '1b', device: str = 'auto'):
+    # Most (path, size, mtime) entries cached before the oldest are evicted;
+    # evicted files are still recognized by their label map on disk
+    PROCESSED_CAP = 10_000
+    # Most failed file versions remembered so sweeps do not retry them
+    FAILED_CAP = 10_000
+    
+    def __init__(self, output_dir: str, model_size: str = '1b', device: str = 'auto',
+                 emit_per_part: bool = False):
         self.output_dir = output_dir
+        self.emit_per_part = emit_per_part
         self.service = None
         self.model_size = model_size
         self.device = device
-        self.processed_files = set()
+        self.processed_files = OrderedDict()
+        self.failed_files = OrderedDict()
+        self._processed_lock = threading.Lock()
         self._initialize_service()
     
     def _initialize_service(self):
@@ -53,42 +72,157 @@ class ImageProcessor:
             logger.error(f"❌ Failed to initialize Sapiens service: {e}")
             raise
     
-    def process_image(self, image_path: str) -> bool:
-        if image_path in self.processed_files:
+    @staticmethod
+    def file_key(image_path: str):
+        """Identify a file version so a replaced file is processed again"""
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        return (image_path, stat.st_size, stat.st_mtime_ns)
+    
+    def is_processed(self, image_path: str) -> bool:
+        """
+        True if this file version was processed, by this run or an earlier one
+        
+        The in-memory record is bounded, so a file missing from it counts as
+        processed when its <stem>_labels.png in the output directory is at
+        least as new as the file itself.
+        """
+        key = self.file_key(image_path)
+        if key is None:
+            return False
+        with self._processed_lock:
+            if key in self.processed_files:
+                self.processed_files.move_to_end(key)
+                return True
+        
+        try:
+            labels_mtime = os.stat(self._labels_path(image_path)).st_mtime_ns
+        except OSError:
+            return False
+        if labels_mtime < key[2]:
+            return False
+        
+        with self._processed_lock:
+            self._remember(self.processed_files, key, self.PROCESSED_CAP)
+        return True
+    
+    def _labels_path(self, image_path: str) -> str:
+        """Label map that save_segmentation_masks() writes for an image"""
+        return os.path.join(self.output_dir, f"{Path(image_path).stem}_labels.png")
+    
+    def mark_processed(self, image_path: str):
+        key = self.file_key(image_path)
+        if key is None:
+            return
+        with self._processed_lock:
+            self.failed_files.pop(key, None)
+            self._remember(self.processed_files, key, self.PROCESSED_CAP)
+    
+    def has_failed(self, image_path: str) -> bool:
+        """True if this exact file version already failed to decode, segment or save"""
+        key = self.file_key(image_path)
+        with self._processed_lock:
+            return key is not None and key in self.failed_files
+    
+    def mark_failed(self, key):
+        """Remember a failed file version; a rewritten file gets a new key and is retried"""
+        if key is None:
+            return
+        with self._processed_lock:
+            self._remember(self.failed_files, key, self.FAILED_CAP)
+    
+    @staticmethod
+    def _remember(record: OrderedDict, key, cap: int):
+        record[key] = None
+        record.move_to_end(key)
+        while len(record) > cap:
+            record.popitem(last=False)
+    
+    def process_image(self, image_path: str, image=None) -> bool:
+        if self.is_processed(image_path):
             return True
         
         try:
             logger.info(f"🔄 Processing: {os.path.basename(image_path)}")
             start_time = time.time()
             
-            result = self.service.segment_image(image_path)
-            
-            if not result['success']:
-                logger.error(f"❌ Segmentation failed: {result['error']}")
-                return False
+            if image is None:
+                result = self.service.segment_image(image_path)
+            else:
+                result = self.service.segment_decoded(image, start_time)
             
-            save_result = self.service.save_segmentation_masks(
-                image_path, self.output_dir, result
-            )
-            
-            if not save_result['success']:
-                logger.error(f"❌ Failed to save masks: {save_result['error']}")
-                return False
+            return self._save_result(image_path, result, start_time)
             
-            processing_time = time.time() - start_time
-            logger.info(f"✅ Completed in {processing_time:.1f}s - {result['total_parts_found']} body parts")
+        except Exception as e:
+            logger.error(f"❌ Error processing {image_path}: {e}")
+            return False
+    
+    def process_batch(self, items: List[Tuple[str, object, tuple]]) -> List[bool]:
+        """Segment (path, image, prepared) items in one forward pass and save their masks"""
+        try:
+            for image_path, _, _ in items:
+                logger.info(f"🔄 Processing: {os.path.basename(image_path)}")
+            start_time = time.time()
             
-            self.processed_files.add(image_path)
-            return True
+            results = self.service.segment_images(
+                [image for _, image, _ in items], start_time,
+                prepared=[prepared for _, _, prepared in items]
+            )
             
         except Exception as e:
-            logger.error(f"❌ Error processing {image_path}: {e}")
+            logger.error(f"❌ Error processing batch of {len(items)}: {e}")
+            return [False] * len(items)
+        
+        successes = []
+        for (image_path, _, _), result in zip(items, results):
+            try:
+                successes.append(self._save_result(image_path, result, start_time))
+            except Exception as e:
+                logger.error(f"❌ Error processing {image_path}: {e}")
+                successes.append(False)
+        return successes
+    
+    def _save_result(self, image_path: str, result: dict, start_time: float) -> bool:
+        if not result['success']:
+            logger.error(f"❌ Segmentation failed: {result['error']}")
             return False
+        
+        save_result = self.service.save_segmentation_masks(
+            image_path, self.output_dir, result, emit_per_part=self.emit_per_part
+        )
+        
+        if not save_result['success']:
+            logger.error(f"❌ Failed to save masks: {save_result['error']}")
+            return False
+        
+        processing_time = time.time() - start_time
+        logger.info(f"✅ Completed in {processing_time:.1f}s - {result['total_parts_found']} body parts")
+        
+        self.mark_processed(image_path)
+        return True
+
+def _wait_stable(file_path: str, max_wait: float = 2.0, interval: float = 0.05) -> bool:
+    """Poll until a file has a non-zero size that stops changing"""
+    last_size = -1
+    size = 0
+    deadline = time.time() + max_wait
+    while time.time() < deadline:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            return False
+        if size == last_size and size > 0:
+            return True
+        last_size = size
+        time.sleep(interval)
+    return size > 0
 
 class ImageHandler(FileSystemEventHandler):
-    def __init__(self, processing_queue: queue.Queue):
-        self.processing_queue = processing_queue
-        self.supported_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff'}
+    def __init__(self, staging_queue: queue.Queue):
+        self.staging_queue = staging_queue
+        self.supported_extensions = SUPPORTED_EXTENSIONS
     
     def on_created(self, event):
         if event.is_directory:
@@ -97,24 +231,43 @@ class ImageHandler(FileSystemEventHandler):
         file_path = event.src_path
         file_ext = Path(file_path).suffix.lower()
         
+        # Hand off immediately; the staging worker waits for the write to finish
         if file_ext in self.supported_extensions:
-            time.sleep(0.5)  # Wait for file to be fully written
-            
-            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                logger.info(f"📸 New image: {os.path.basename(file_path)}")
-                self.processing_queue.put(file_path)
+            self.staging_queue.put(file_path)
 
 class SapiensWatcher:
-    def __init__(self, watch_dir: str, output_dir: str, model_size: str = '1b', device: str = 'auto'):
+    # Most decoded images handed to a single forward pass
+    MAX_BATCH = 4
+    # Threads decoding and uploading images ahead of the model
+    PREPROCESS_WORKERS = 2
+    # Seconds between directory sweeps that catch files missed by the event source
+    SWEEP_INTERVAL = 30.0
+    # Seconds a file's mtime must be in the past before a sweep queues it
+    SWEEP_SETTLE = 2.0
+    
+    def __init__(self, watch_dir: str, output_dir: str, model_size: str = '1b', device: str = 'auto',
+                 emit_per_part: bool = False):
         self.watch_dir = watch_dir
         self.output_dir = output_dir
+        self.emit_per_part = emit_per_part
         self.model_size = model_size
         self.device = device
+        self.staging_queue = queue.Queue()
         self.processing_queue = queue.Queue(maxsize=100)
+        self.decoded_queue = queue.Queue(maxsize=self.MAX_BATCH)
         self.processor = None
         self.observer = None
         self.event_handler = None
+        self.staging_thread = None
+        self.decode_threads = []
+        # Queued path -> file key taken when its decode started
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
         self.processing_thread = None
+        self.inotify = None
+        self.inotify_thread = None
+        self.sweep_thread = None
+        self._stop_event = threading.Event()
         self.running = False
     
     def _initialize_processor(self):
@@ -122,26 +275,83 @@ class SapiensWatcher:
             self.processor = ImageProcessor(
                 output_dir=self.output_dir,
                 model_size=self.model_size,
-                device=self.device
+                device=self.device,
+                emit_per_part=self.emit_per_part
             )
+            self.processor.service.ensure_output_dirs(self.output_dir)
         except Exception as e:
             logger.error(f"❌ Failed to initialize processor: {e}")
             raise
     
+    def _staging_worker(self):
+        """Wait for new files to finish writing before queueing them, off the watchdog thread"""
+        while self.running:
+            try:
+                file_path = self.staging_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            
+            try:
+                if _wait_stable(file_path):
+                    logger.info(f"📸 New image: {os.path.basename(file_path)}")
+                    self.processing_queue.put(file_path)
+            finally:
+                self.staging_queue.task_done()
+    
+    def _decode_worker(self):
+        """Decode and upload queued images ahead of the model so preprocessing overlaps inference"""
+        logger.info("🖼️ Decode worker started")
+        
+        while self.running:
+            try:
+                image_path = self.processing_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            
+            # Two decode workers share the queue; drop repeats of an image already in flight
+            with self._in_flight_lock:
+                if image_path in self._in_flight:
+                    self.processing_queue.task_done()
+                    continue
+                self._in_flight[image_path] = ImageProcessor.file_key(image_path)
+            
+            if self.processor.is_processed(image_path):
+                self._finish(image_path)
+                continue
+            
+            try:
+                image = self.processor.service.load_image(image_path)
+                prepared = self.processor.service.preprocess(image)
+            except Exception as e:
+                logger.error(f"❌ Failed to decode {os.path.basename(image_path)}: {e}")
+                self._finish(image_path, failed=True)
+                continue
+            
+            self.decoded_queue.put((image_path, image, prepared))
+        
+        logger.info("🛑 Decode worker stopped")
+    
     def _processing_worker(self):
         logger.info("🔄 Processing worker started")
         
         while self.running:
             try:
-                image_path = self.processing_queue.get(timeout=1.0)
-                success = self.processor.process_image(image_path)
+                batch = [self.decoded_queue.get(timeout=1.0)]
+                while len(batch) < self.MAX_BATCH:
+                    try:
+                        batch.append(self.decoded_queue.get_nowait())
+                    except queue.Empty:
+                        break
                 
-                if success:
-                    logger.info(f"✅ Processed: {os.path.basename(image_path)}")
-                else:
-                    logger.error(f"❌ Failed: {os.path.basename(image_path)}")
+                successes = self.processor.process_batch(batch)
                 
-                self.processing_queue.task_done()
+                for (image_path, _, _), success in zip(batch, successes):
+                    if success:
+                        logger.info(f"✅ Processed: {os.path.basename(image_path)}")
+                    else:
+                        logger.error(f"❌ Failed: {os.path.basename(image_path)}")
+                    
+                    self._finish(image_path, failed=not success)
                 
             except queue.Empty:
                 continue
@@ -151,16 +361,89 @@ class SapiensWatcher:
         
         logger.info("🛑 Processing worker stopped")
     
+    def _finish(self, image_path: str, failed: bool = False):
+        """Mark a queued image as fully handled, remembering the file version if it failed"""
+        with self._in_flight_lock:
+            key = self._in_flight.pop(image_path, None)
+        if failed:
+            self.processor.mark_failed(key)
+        self.processing_queue.task_done()
+    
     def _setup_file_watcher(self):
         if not os.path.exists(self.watch_dir):
             logger.error(f"❌ Watch directory not found: {self.watch_dir}")
             raise FileNotFoundError(f"Watch directory not found: {self.watch_dir}")
         
-        self.event_handler = ImageHandler(self.processing_queue)
+        # On Linux, the kernel reports CLOSE_WRITE once the writer is done, so
+        # files skip the staging wait entirely
+        if platform.system() == 'Linux' and INotify is not None:
+            self.inotify = INotify()
+            self.inotify.add_watch(self.watch_dir, inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+            logger.info(f"👀 Watching (inotify): {self.watch_dir}")
+            return
+        
+        if platform.system() == 'Linux':
+            logger.warning("⚠️ inotify_simple not installed, falling back to watchdog "
+                           "(pip install inotify_simple)")
+        
+        self.event_handler = ImageHandler(self.staging_queue)
         self.observer = Observer()
         self.observer.schedule(self.event_handler, self.watch_dir, recursive=False)
         logger.info(f"👀 Watching: {self.watch_dir}")
     
+    def _inotify_worker(self):
+        """Drain inotify events in batches and queue each completed image once"""
+        while not self._stop_event.is_set():
+            events = self.inotify.read(timeout=100)
+            
+            names = []
+            for event in events:
+                if event.name and event.name not in names:
+                    names.append(event.name)
+            
+            for name in names:
+                if Path(name).suffix.lower() in SUPPORTED_EXTENSIONS:
+                    logger.info(f"📸 New image: {name}")
+                    self.processing_queue.put(os.path.join(self.watch_dir, name))
+    
+    def _sweep(self):
+        """
+        Queue every unprocessed image in the watch folder
+        
+        Syncthing preserves the sender's mtimes, so a freshly synced file can
+        look older than the previous sweep; only is_processed() decides.
+        File versions that already failed are skipped until they change.
+        
+        Sweep hits skip the staging wait, so files modified within
+        SWEEP_SETTLE may still be being written; they are left to their close
+        event or the next sweep.
+        """
+        settled_before = time.time() - self.SWEEP_SETTLE
+        
+        with os.scandir(self.watch_dir) as entries:
+            paths = sorted(
+                entry.path for entry in entries
+                if entry.is_file()
+                and Path(entry.name).suffix.lower() in SUPPORTED_EXTENSIONS
+                and entry.stat().st_mtime < settled_before
+            )
+        
+        queued = 0
+        for path in paths:
+            if not self.processor.is_processed(path) and not self.processor.has_failed(path):
+                self.processing_queue.put(path)
+                queued += 1
+        
+        if queued:
+            logger.info(f"🔍 Sweep queued {queued} image(s)")
+    
+    def _sweep_worker(self):
+        while not self._stop_event.wait(self.SWEEP_INTERVAL):
+            try:
+                self._sweep()
+            except Exception as e:
+                logger.error(f"❌ Sweep error: {e}")
+    
     def start(self):
         try:
             logger.info("🚀 Starting Sapiens Watcher...")
@@ -173,10 +456,27 @@ class SapiensWatcher:
             self._setup_file_watcher()
             
             self.running = True
+            self.staging_thread = threading.Thread(target=self._staging_worker, daemon=True)
+            self.staging_thread.start()
+            self.decode_threads = [
+                threading.Thread(target=self._decode_worker, daemon=True)
+                for _ in range(self.PREPROCESS_WORKERS)
+            ]
+            for thread in self.decode_threads:
+                thread.start()
             self.processing_thread = threading.Thread(target=self._processing_worker, daemon=True)
             self.processing_thread.start()
             
-            self.observer.start()
+            # Pick up images delivered while the watcher was down
+            self._sweep()
+            self.sweep_thread = threading.Thread(target=self._sweep_worker, daemon=True)
+            self.sweep_thread.start()
+            
+            if self.inotify:
+                self.inotify_thread = threading.Thread(target=self._inotify_worker, daemon=True)
+                self.inotify_thread.start()
+            else:
+                self.observer.start()
             logger.info("✅ Sapiens Watcher started!")
             logger.info("Press Ctrl+C to stop...")
             
@@ -193,20 +493,33 @@ class SapiensWatcher:
     
     def stop(self):
         logger.info("🛑 Stopping Sapiens Watcher...")
-        self.running = False
+        self._stop_event.set()
         
-        if self.observer:
+        if self.observer and self.observer.is_alive():
             self.observer.stop()
             self.observer.join()
         
-        if self.processing_queue:
+        for thread in (self.inotify_thread, self.sweep_thread):
+            if thread and thread.is_alive():
+                thread.join(timeout=5.0)
+        
+        if self.inotify:
+            self.inotify.close()
+        
+        # Drain while every stage is still running; decoded items are only
+        # marked done by the processing worker
+        if self.running:
             try:
+                self.staging_queue.join()
                 self.processing_queue.join()
             except:
                 pass
         
-        if self.processing_thread and self.processing_thread.is_alive():
-            self.processing_thread.join(timeout=5.0)
+        self.running = False
+        
+        for thread in (self.staging_thread, *self.decode_threads, self.processing_thread):
+            if thread and thread.is_alive():
+                thread.join(timeout=5.0)
         
         logger.info("👋 Stopped")
 
@@ -220,6 +533,8 @@ def main():
                        help='Output directory for body parts')
     parser.add_argument('--model-size', default='1b', choices=['0.3b', '0.6b', '1b', '2b'])
     parser.add_argument('--device', default='auto', choices=['auto', 'cpu', 'cuda', 'mps'])
+    parser.add_argument('--emit-per-part', action='store_true',
+                       help='Also write one colored PNG per body part next to the label map')
     
     args = parser.parse_args()
     
@@ -227,7 +542,8 @@ def main():
         watch_dir=args.watch_dir,
         output_dir=args.output_dir,
         model_size=args.model_size,
-        device=args.device
+        device=args.device,
+        emit_per_part=args.emit_per_part
     )
     
     watcher.start()
@@ -6,12 +6,17 @@ Uses the Sapiens-Pytorch-Inference library for accurate body part segmentation
 
 import os
 import time
+import colorsys
+import hashlib
 import logging
-from pathlib import Path
-from typing import Dict, List, Set
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set
 import numpy as np
-from PIL import Image
 import cv2
+import torch
+import torch.nn.functional as F
 
 # Sapiens imports
 try:
@@ -20,6 +25,12 @@ except ImportError:
     print("❌ Sapiens inference not found. Install with: pip install sapiens-inference")
     raise
 
+# Optional: numba fuses label counting and bounding boxes into one pass
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -27,6 +38,34 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+if njit is not None:
+    # Serial on purpose: the watcher calls this from worker threads, where numba's
+    # parallel TBB layer hangs interpreter exit, and one pass is already memory-bound
+    @njit(cache=True)
+    def _label_stats(mask):
+        """Pixel count and inclusive bounding box of every label, in one pass"""
+        h, w = mask.shape
+        n = int(mask.max()) + 1 if mask.size else 1
+        counts = np.zeros(n, np.int64)
+        x0 = np.full(n, w, np.int64)
+        y0 = np.full(n, h, np.int64)
+        x1 = np.full(n, -1, np.int64)
+        y1 = np.full(n, -1, np.int64)
+        for y in range(h):
+            for x in range(w):
+                label = mask[y, x]
+                counts[label] += 1
+                if x < x0[label]:
+                    x0[label] = x
+                if x > x1[label]:
+                    x1[label] = x
+                if y < y0[label]:
+                    y0[label] = y
+                y1[label] = y
+        return counts, x0, y0, x1, y1
+else:
+    _label_stats = None
+
 class SapiensProcessor:
     """Handles Sapiens model loading and image processing"""
     
@@ -40,20 +79,91 @@ class SapiensProcessor:
         'right_leg': ['right_hip', 'right_thigh', 'right_knee', 'right_shin', 'right_ankle', 'right_foot']
     }
     
-    def __init__(self, model_size: str = '1b', device: str = 'auto'):
+    # Simplified Sapiens label mapping - in practice, you'd use the actual Sapiens label mapping
+    LABEL_NAMES = {
+        1: 'head',
+        2: 'torso',
+        3: 'left_arm',
+        4: 'right_arm',
+        5: 'left_leg',
+        6: 'right_leg',
+        7: 'left_hand',
+        8: 'right_hand',
+        9: 'left_foot',
+        10: 'right_foot'
+    }
+    
+    # Group ids index this tuple; parts outside BODY_PART_GROUPS land in 'other'
+    GROUP_NAMES = tuple(BODY_PART_GROUPS) + ('other',)
+    
+    # Network input (height, width) and normalization of the Sapiens checkpoints
+    INPUT_SIZE = (1024, 768)
+    MEAN = [123.675, 116.28, 103.53]
+    STD = [58.395, 57.12, 57.375]
+    
+    # Background PNG writers, how many writes may wait on them before saving blocks,
+    # and a fast zlib level for the files they write
+    SAVE_WORKERS = 4
+    MAX_PENDING_WRITES = 8 * SAVE_WORKERS
+    PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    
+    # Below this foreground fraction, part statistics only scan the foreground's bounding box
+    SPARSE_FRACTION = 0.05
+    
+    def __init__(self, model_size: str = '1b', device: str = 'auto', batch_size: int = 8,
+                 use_fp16: bool = True):
         """
         Initialize the Sapiens processor
         
         Args:
             model_size: Model size ('0.3b', '0.6b', '1b', '2b')
             device: Device to use ('auto', 'cpu', 'cuda', 'mps')
+            batch_size: Maximum number of images per batched forward pass
+            use_fp16: Run the model in half precision when it is on a CUDA device
         """
         self.model_size = model_size
         self.device = device
+        self.batch_size = batch_size
+        self.use_fp16 = use_fp16
+        self._fp16_active = False
+        self._compiled = False
+        self._staging: Optional[torch.Tensor] = None
         self.predictor = None
-        self.processed_files: Set[str] = set()
+        self._label_to_group = self._build_group_lut()
+        self._color_cache = self._build_color_cache()
+        self._io_pool = ThreadPoolExecutor(max_workers=self.SAVE_WORKERS, thread_name_prefix='sapiens-save')
+        self._write_lock = threading.Lock()
+        self._write_futures: Set[Future] = set()
+        # output_dir -> {group name: group directory}, for directories already created
+        self._group_dirs: Dict[str, Dict[str, str]] = {}
+        # part name -> per-channel (R, G, B) 256-entry LUTs painting nonzero mask pixels
+        self._channel_luts: Dict[str, tuple] = {}
+        # Per save-pool thread uint8 part-mask buffer, reused while the mask shape repeats
+        self._scratch = threading.local()
+        if _label_stats is not None:
+            # Compile (or load from the numba cache) now rather than on the first image
+            _label_stats(np.zeros((1, 1), dtype=np.uint8))
         self._load_model()
     
+    def _build_group_lut(self) -> np.ndarray:
+        """Flatten LABEL_NAMES and BODY_PART_GROUPS into one label -> group id table"""
+        group_of_part = {part: group_id for group_id, group_name in enumerate(self.BODY_PART_GROUPS)
+                         for part in self.BODY_PART_GROUPS[group_name]}
+        other = len(self.GROUP_NAMES) - 1
+        
+        # Labels fit in uint8, so one 256-entry table covers every label
+        lut = np.full(256, other, dtype=np.uint8)
+        for label, part_name in self.LABEL_NAMES.items():
+            lut[label] = group_of_part.get(part_name, other)
+        return lut
+    
+    def _build_color_cache(self) -> Dict[str, tuple]:
+        """Precompute the color of every known body part name"""
+        names = set(self.LABEL_NAMES.values())
+        for parts in self.BODY_PART_GROUPS.values():
+            names.update(parts)
+        return {name: self._part_color(name) for name in names}
+    
     def _load_model(self):
         """Load the Sapiens model"""
         try:
@@ -66,6 +176,7 @@ class SapiensProcessor:
             
             # Initialize predictor
             self.predictor = SapiensPredictor(config)
+            self._prepare_network()
             
             logger.info(f"✅ Sapiens-{self.model_size} model loaded successfully")
             
@@ -74,40 +185,246 @@ class SapiensProcessor:
             logger.error("💡 Make sure sapiens-inference is installed: pip install sapiens-inference")
             raise
     
+    def _prepare_network(self):
+        """Put the underlying module in eval mode, in FP16 when enabled on CUDA, and compile it"""
+        owner = self._network_owner()
+        if owner is None:
+            return
+        
+        network = owner.model
+        network.eval()
+        param = next(network.parameters(), None)
+        if param is None or param.device.type != 'cuda':
+            return
+        
+        # Persistent pinned NHWC upload buffer for a full (power-of-two padded) batch
+        self._staging_rows(1 << (self.batch_size - 1).bit_length())
+        
+        if self.use_fp16:
+            network.half()
+            self._fp16_active = True
+            logger.info("⚡ Running Sapiens in FP16")
+        
+        if hasattr(torch, 'compile'):
+            try:
+                owner.model = torch.compile(network, mode='reduce-overhead', fullgraph=False, dynamic=False)
+                self._compiled = True
+                # Pay compilation and CUDA graph capture now rather than on the first batches
+                self._warmup(owner.model, param.device)
+                logger.info("⚡ Sapiens model compiled (reduce-overhead)")
+            except Exception as e:
+                logger.warning(f"⚠️ torch.compile failed, using eager model: {e}")
+                owner.model = network
+                self._compiled = False
+    
+    def _warmup(self, network: torch.nn.Module, device: torch.device, iterations: int = 2):
+        """Run forwards on zero batches of every shape, dtype and memory format _forward_batch feeds"""
+        param = next(network.parameters(), None)
+        dtype = param.dtype if param is not None else torch.float32
+        
+        # _forward_batch pads every batch up to a power of two, so these are all the shapes it
+        # produces; with dynamic=False each one compiles and captures its own graph
+        for rows in sorted({1 << (n - 1).bit_length() for n in range(1, self.batch_size + 1)}):
+            x = torch.zeros(rows, 3, *self.INPUT_SIZE, device=device, dtype=dtype)
+            x = x.contiguous(memory_format=torch.channels_last)
+            with self._infer_ctx():
+                for _ in range(iterations):
+                    network(x)
+    
+    @contextmanager
+    def _infer_ctx(self):
+        """No autograd during inference; autocast keeps FP32 inputs compatible with FP16 weights"""
+        with torch.inference_mode():
+            if self._fp16_active:
+                with torch.autocast(device_type='cuda', dtype=torch.float16):
+                    yield
+            else:
+                yield
+    
     def segment_image(self, image_path: str) -> Dict:
         """Segment body parts in an image using Sapiens"""
+        # A batch of one, so single images take the same inference path as batches
+        return self.segment_batch([image_path])[0]
+    
+    def segment_batch(self, image_paths: List[str], images: Optional[List[np.ndarray]] = None,
+                      inputs: Optional[List[Optional[np.ndarray]]] = None) -> List[Dict]:
+        """
+        Segment several images, sharing one forward pass when the model is reachable
+        
+        Whenever the torch module is reachable every image goes through _forward_batch(),
+        whatever the batch size, so a mask never depends on how many images arrived
+        together; otherwise each image goes through the predictor.
+        
+        Args:
+            image_paths: Paths of the images, used for loading and in the results
+            images: Already decoded RGB images, one per path; loaded from disk when omitted
+            inputs: Network inputs from prepare_input(), one per image; resized here when omitted
+        """
+        results: List[Dict] = [None] * len(image_paths)
+        loaded = []
+        for index, image_path in enumerate(image_paths):
+            if images is not None:
+                loaded.append((index, image_path, images[index]))
+                continue
+            try:
+                loaded.append((index, image_path, self.load_image(image_path)))
+            except Exception as e:
+                logger.error(f"❌ Error segmenting image: {e}")
+                results[index] = {'success': False, 'error': str(e)}
+        
+        network = self._find_network()
+        if network is None:
+            for index, image_path, image_array in loaded:
+                results[index] = self._segment_array(image_path, image_array)
+            return results
+        
+        for _, image_path, image_array in loaded:
+            logger.info(f"📸 Processing: {os.path.basename(image_path)} ({image_array.shape[1]}x{image_array.shape[0]})")
+        
+        if len(loaded) > 1:
+            try:
+                masks = self._forward_batch(network, [image_array for _, _, image_array in loaded],
+                                            [inputs[index] for index, _, _ in loaded] if inputs else None)
+                for (index, image_path, image_array), segmentation_mask in zip(loaded, masks):
+                    results[index] = self._build_result(image_path, image_array, segmentation_mask)
+                return results
+                
+            except Exception as e:
+                logger.warning(f"⚠️ Batched inference failed, falling back to one image at a time: {e}")
+        
+        # Batches of one, still through the same preprocessing and network call
+        for index, image_path, image_array in loaded:
+            try:
+                masks = self._forward_batch(network, [image_array], [inputs[index]] if inputs else None)
+                results[index] = self._build_result(image_path, image_array, masks[0])
+            except Exception as e:
+                logger.error(f"❌ Error segmenting image: {e}")
+                results[index] = {'success': False, 'error': str(e)}
+        return results
+    
+    def load_image(self, image_path: str) -> np.ndarray:
+        """Load an image as an RGB array"""
+        image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if image is None and os.path.isfile(image_path):
+            # cv2.imread cannot open some non-ASCII paths (notably on Windows); decode the bytes instead
+            image = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Could not read image: {image_path}")
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    
+    def prepare_input(self, image_array: np.ndarray) -> Optional[np.ndarray]:
+        """Resize an image to the network input ahead of segment_batch(), or None without a reachable network"""
+        if self._find_network() is None:
+            return None
+        height, width = self.INPUT_SIZE
+        return cv2.resize(image_array, (width, height), interpolation=cv2.INTER_LINEAR)
+    
+    def _segment_array(self, image_path: str, image_array: np.ndarray) -> Dict:
+        """Run the predictor on one decoded image, for predictors that do not expose their module"""
         try:
-            # Load image
-            image = Image.open(image_path).convert('RGB')
-            image_array = np.array(image)
-            
             logger.info(f"📸 Processing: {os.path.basename(image_path)} ({image_array.shape[1]}x{image_array.shape[0]})")
             
             # Run Sapiens segmentation
-            result = self.predictor(image_array)
+            with self._infer_ctx():
+                result = self.predictor(image_array)
             
             # Extract segmentation mask from result
             segmentation_mask = self._extract_segmentation_mask(result)
             
-            # Extract individual body parts
-            body_parts = self._extract_body_parts(segmentation_mask, image_array.shape)
-            
-            return {
-                'success': True,
-                'image_path': image_path,
-                'segmentation_mask': segmentation_mask,
-                'body_parts': body_parts,
-                'total_parts': len(body_parts),
-                'model_info': {
-                    'model': f'Sapiens-{self.model_size}',
-                    'device': self.device
-                }
-            }
+            return self._build_result(image_path, image_array, segmentation_mask)
             
         except Exception as e:
             logger.error(f"❌ Error segmenting image: {e}")
             return {'success': False, 'error': str(e)}
     
+    def result_from_mask(self, image_path: str, segmentation_mask: np.ndarray) -> Dict:
+        """Build a segmentation result for an image from an existing label mask, without inference"""
+        return self._build_result(image_path, segmentation_mask, segmentation_mask)
+    
+    def load_saved_mask(self, image_path: str, output_dir: str) -> Optional[np.ndarray]:
+        """Read back the full label mask save_segmentation() wrote for an image, or None if it is missing"""
+        mask_path = self._full_mask_path(output_dir, image_path)
+        if not os.path.isfile(mask_path):
+            return None
+        return cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
+    
+    def _build_result(self, image_path: str, image_array: np.ndarray, segmentation_mask: np.ndarray) -> Dict:
+        """Assemble the result dictionary for a segmented image"""
+        # Extract individual body parts
+        body_parts = self._extract_body_parts(segmentation_mask, image_array.shape)
+        
+        return {
+            'success': True,
+            'image_path': image_path,
+            'segmentation_mask': segmentation_mask,
+            'body_parts': body_parts,
+            'total_parts': len(body_parts),
+            'model_info': {
+                'model': f'Sapiens-{self.model_size}',
+                'device': self.device
+            }
+        }
+    
+    def _network_owner(self):
+        """Object holding the torch module behind the predictor as .model, if any"""
+        for owner in (self.predictor, getattr(self.predictor, 'segmentation_predictor', None)):
+            if isinstance(getattr(owner, 'model', None), torch.nn.Module):
+                return owner
+        return None
+    
+    def _find_network(self):
+        """Locate the torch module behind the predictor, if it exposes one"""
+        owner = self._network_owner()
+        return owner.model if owner is not None else None
+    
+    def _staging_rows(self, rows: int) -> torch.Tensor:
+        """First rows of the pinned upload buffer, reallocated only when a batch outgrows it"""
+        if self._staging is None or self._staging.shape[0] < rows:
+            height, width = self.INPUT_SIZE
+            self._staging = torch.empty((rows, height, width, 3), dtype=torch.uint8, pin_memory=True)
+        return self._staging[:rows]
+    
+    def _forward_batch(self, network: torch.nn.Module, images: List[np.ndarray],
+                       inputs: Optional[List[Optional[np.ndarray]]] = None) -> List[np.ndarray]:
+        """Resize images to the network input, run them as one NCHW batch and return label masks"""
+        height, width = self.INPUT_SIZE
+        param = next(network.parameters(), None)
+        device = param.device if param is not None else torch.device('cpu')
+        dtype = param.dtype if param is not None else torch.float32
+        
+        # Pad to a power-of-two batch so the compiled graph specializes on few shapes
+        rows = 1 << (len(images) - 1).bit_length() if self._compiled else len(images)
+        if device.type == 'cuda':
+            # Resize straight into the pinned buffer; the previous batch's upload has
+            # completed because its masks were copied back before returning
+            tensor = self._staging_rows(rows)
+        else:
+            tensor = torch.empty((rows, height, width, 3), dtype=torch.uint8)
+        host = tensor.numpy()
+        for i, (image, resized) in enumerate(zip(images, inputs or [None] * len(images))):
+            if resized is not None:
+                np.copyto(host[i], resized)
+            else:
+                cv2.resize(image, (width, height), dst=host[i], interpolation=cv2.INTER_LINEAR)
+        host[len(images):] = 0
+        
+        with self._infer_ctx():
+            x = tensor.to(device, non_blocking=True).permute(0, 3, 1, 2).float()
+            mean = torch.tensor(self.MEAN, device=device).view(1, 3, 1, 1)
+            std = torch.tensor(self.STD, device=device).view(1, 3, 1, 1)
+            x = ((x - mean) / std).to(dtype).contiguous(memory_format=torch.channels_last)
+            
+            logits = network(x)
+            if isinstance(logits, (tuple, list)):
+                logits = logits[0]
+            
+            masks = []
+            for i, image in enumerate(images):
+                upsampled = F.interpolate(logits[i:i + 1].float(), size=image.shape[:2],
+                                          mode='bilinear', align_corners=False)
+                masks.append(upsampled.argmax(1)[0].to(torch.uint8).cpu().numpy())
+            return masks
+    
     def _extract_segmentation_mask(self, result) -> np.ndarray:
         """Extract segmentation mask from Sapiens result"""
         try:
@@ -133,31 +450,45 @@ class SapiensProcessor:
         body_parts = []
         
         try:
-            # Get unique labels in the segmentation
-            unique_labels = np.unique(segmentation_mask)
+            # A small subject on a large canvas: crop to the foreground before counting
+            foreground = segmentation_mask if segmentation_mask.dtype == np.uint8 else \
+                (segmentation_mask > 0).view(np.uint8)
+            ox = oy = 0
+            if cv2.countNonZero(foreground) < self.SPARSE_FRACTION * segmentation_mask.size:
+                ox, oy, w, h = cv2.boundingRect(foreground)
+                segmentation_mask = segmentation_mask[oy:oy + h, ox:ox + w]
+            
+            # Count every label in one pass; part masks are built only when saving
+            if _label_stats is not None:
+                # Always the C-contiguous uint8 signature compiled in __init__, even for a
+                # cropped view or a non-uint8 predictor mask (labels fit in uint8)
+                counts, x0, y0, x1, y1 = _label_stats(np.ascontiguousarray(segmentation_mask, dtype=np.uint8))
+            else:
+                counts = np.bincount(segmentation_mask.ravel().astype(np.intp, copy=False))
             
-            for label in unique_labels:
-                if label == 0:  # Skip background
+            # Only include parts with significant pixels, skipping background
+            for label in np.nonzero(counts > 100)[0]:
+                if label == 0:
                     continue
                 
-                # Create mask for this body part
-                part_mask = (segmentation_mask == label).astype(np.uint8) * 255
+                # Map label to body part name (simplified mapping)
+                part_name = self._map_label_to_part_name(int(label))
+                group = self._get_part_group(int(label))
                 
-                # Count pixels
-                pixel_count = np.sum(part_mask > 0)
+                # Bounding box (x, y, width, height) of the surviving label only
+                if _label_stats is not None:
+                    x, y = int(x0[label]), int(y0[label])
+                    w, h = int(x1[label]) - x + 1, int(y1[label]) - y + 1
+                else:
+                    x, y, w, h = cv2.boundingRect((segmentation_mask == label).view(np.uint8))
                 
-                if pixel_count > 100:  # Only include parts with significant pixels
-                    # Map label to body part name (simplified mapping)
-                    part_name = self._map_label_to_part_name(label)
-                    group = self._get_part_group(part_name)
-                    
-                    body_parts.append({
-                        'name': part_name,
-                        'label_id': int(label),
-                        'pixel_count': int(pixel_count),
-                        'mask': part_mask,
-                        'group': group
-                    })
+                body_parts.append({
+                    'name': part_name,
+                    'label_id': int(label),
+                    'pixel_count': int(counts[label]),
+                    'bbox': (x + ox, y + oy, w, h),
+                    'group': group
+                })
             
             return body_parts
             
@@ -167,92 +498,149 @@ class SapiensProcessor:
     
     def _map_label_to_part_name(self, label: int) -> str:
         """Map Sapiens label to body part name"""
-        # Simplified mapping - in practice, you'd use the actual Sapiens label mapping
-        label_mapping = {
-            1: 'head',
-            2: 'torso',
-            3: 'left_arm',
-            4: 'right_arm',
-            5: 'left_leg',
-            6: 'right_leg',
-            7: 'left_hand',
-            8: 'right_hand',
-            9: 'left_foot',
-            10: 'right_foot'
-        }
-        return label_mapping.get(label, f'part_{label}')
+        return self.LABEL_NAMES.get(label, f'part_{label}')
     
-    def _get_part_group(self, part_name: str) -> str:
-        """Determine which group a body part belongs to"""
-        for group_name, parts in self.BODY_PART_GROUPS.items():
-            if part_name in parts:
-                return group_name
-        return 'other'
+    def _get_part_group(self, label: int) -> str:
+        """Determine which group a Sapiens label belongs to"""
+        if label >= len(self._label_to_group):
+            return self.GROUP_NAMES[-1]
+        return self.GROUP_NAMES[self._label_to_group[label]]
     
-    def save_segmentation(self, image_path: str, output_dir: str, result: Dict) -> bool:
-        """Save segmentation results organized by body parts"""
+    def save_segmentation(self, image_path: str, output_dir: str, result: Dict) -> List[Future]:
+        """
+        Queue segmentation results for saving, organized by body parts
+        
+        Returns:
+            One future per file being written, raising if its write failed;
+            empty if nothing could be queued
+        """
         if not result['success']:
-            return False
+            return []
+        
+        base_name = os.path.splitext(os.path.basename(image_path))[0]
         
         try:
-            # Create output directory structure
-            output_path = Path(output_dir)
-            output_path.mkdir(parents=True, exist_ok=True)
-            
-            # Create subdirectories for each body part group
-            for group_name in self.BODY_PART_GROUPS.keys():
-                (output_path / group_name).mkdir(parents=True, exist_ok=True)
+            group_dirs = self._ensure_output_dirs(output_dir)
+            futures = []
             
-            base_name = Path(image_path).stem
-            saved_files = []
+            segmentation_mask = result['segmentation_mask']
             
-            # Save each body part to its respective folder
+            # Save each body part to its respective folder; encoding runs on the
+            # save pool so the next batch can start while PNGs are compressed
             for part_info in result['body_parts']:
                 part_name = part_info['name']
-                part_mask = part_info['mask']
                 group = part_info['group']
                 
-                # Create colored mask for better visualization
-                colored_mask = self._create_colored_mask(part_mask, part_name)
-                
-                # Save to appropriate folder
-                output_file = output_path / group / f"{part_name}_{base_name}.png"
-                colored_mask.save(output_file)
-                
-                saved_files.append(str(output_file))
-                logger.info(f"💾 Saved {part_name} to: {output_file}")
+                output_file = os.path.join(group_dirs[group], f"{part_name}_{base_name}.png")
+                futures.append(self._submit_write(self._write_part, segmentation_mask, part_info['label_id'],
+                                                  part_name, output_file))
             
             # Also save the full segmentation mask
-            full_mask_path = output_path / f"{base_name}_full_segmentation.png"
-            cv2.imwrite(str(full_mask_path), result['segmentation_mask'])
-            saved_files.append(str(full_mask_path))
+            full_mask_path = self._full_mask_path(output_dir, image_path)
+            futures.append(self._submit_write(self._write_png, full_mask_path, segmentation_mask))
             
-            logger.info(f"✅ Saved {len(saved_files)} files for {base_name}")
-            return True
+            logger.info(f"✅ Queued {len(futures)} files for {base_name}")
+            return futures
             
         except Exception as e:
             logger.error(f"❌ Error saving segmentation: {e}")
-            return False
+            return []
     
-    def _create_colored_mask(self, mask: np.ndarray, part_name: str) -> Image.Image:
-        """Create a colored mask for a body part"""
-        # Generate a consistent color for this body part
-        color = self._get_part_color(part_name)
+    @staticmethod
+    def _full_mask_path(output_dir: str, image_path: str) -> str:
+        """Where the full label mask of an image is saved"""
+        base_name = os.path.splitext(os.path.basename(image_path))[0]
+        return os.path.join(output_dir, f"{base_name}_full_segmentation.png")
+    
+    def _ensure_output_dirs(self, output_dir: str) -> Dict[str, str]:
+        """Create the output directory and its group subdirectories once per output_dir"""
+        group_dirs = self._group_dirs.get(output_dir)
+        if group_dirs is None:
+            group_dirs = {group_name: os.path.join(output_dir, group_name) for group_name in self.GROUP_NAMES}
+            for group_dir in group_dirs.values():
+                os.makedirs(group_dir, exist_ok=True)
+            self._group_dirs[output_dir] = group_dirs
+        return group_dirs
+    
+    def _submit_write(self, fn, *args) -> Future:
+        """Queue a write on the save pool, waiting if too many writes are pending"""
+        with self._write_lock:
+            pending = set(self._write_futures)
+        if len(pending) >= self.MAX_PENDING_WRITES:
+            wait(pending, return_when=FIRST_COMPLETED)
         
-        # Create RGB image
-        colored_mask = np.zeros((mask.shape[0], mask.shape[1], 3), dtype=np.uint8)
-        colored_mask[mask > 0] = color
+        future = self._io_pool.submit(fn, *args)
+        with self._write_lock:
+            self._write_futures.add(future)
+        future.add_done_callback(self._write_done)
+        return future
+    
+    def _write_done(self, future: Future):
+        """Forget a finished write task"""
+        with self._write_lock:
+            self._write_futures.discard(future)
+    
+    def _write_part(self, segmentation_mask: np.ndarray, label_id: int, part_name: str, output_file: str):
+        """Build, colorize and save one body part mask (runs on the save pool)"""
+        try:
+            part_mask = getattr(self._scratch, 'mask', None)
+            if part_mask is None or part_mask.shape != segmentation_mask.shape:
+                part_mask = self._scratch.mask = np.empty(segmentation_mask.shape, dtype=np.uint8)
+            np.equal(segmentation_mask, label_id, out=part_mask.view(bool))
+            np.multiply(part_mask, 255, out=part_mask)
+            
+            # Create colored mask for better visualization
+            colored_mask = self._create_colored_mask(part_mask, part_name)
+            if not cv2.imwrite(output_file, colored_mask, self.PNG_PARAMS):
+                raise IOError("cv2.imwrite returned False")
+            logger.info(f"💾 Saved {part_name} to: {output_file}")
+        except Exception as e:
+            logger.error(f"❌ Error saving {output_file}: {e}")
+            raise
+    
+    def _write_png(self, output_file: str, image: np.ndarray):
+        """Save an image with cv2 at the fast PNG compression level (runs on the save pool)"""
+        try:
+            if not cv2.imwrite(output_file, image, self.PNG_PARAMS):
+                raise IOError("cv2.imwrite returned False")
+        except Exception as e:
+            logger.error(f"❌ Error saving {output_file}: {e}")
+            raise
+    
+    def close(self):
+        """Wait for queued saves to finish and stop the save pool"""
+        self._io_pool.shutdown(wait=True)
+    
+    def _create_colored_mask(self, mask: np.ndarray, part_name: str) -> np.ndarray:
+        """Create a colored mask for a body part, in BGR order for cv2.imwrite"""
+        luts = self._channel_luts.get(part_name)
+        if luts is None:
+            # Generate a consistent color for this body part, one LUT per channel
+            luts = []
+            for value in self._get_part_color(part_name):
+                lut = np.full(256, value, dtype=np.uint8)
+                lut[0] = 0
+                luts.append(lut)
+            luts = self._channel_luts[part_name] = tuple(luts)
         
-        return Image.fromarray(colored_mask)
+        # Create BGR image from three table lookups over the mask
+        mask = mask.astype(np.uint8, copy=False)
+        return cv2.merge([cv2.LUT(mask, lut) for lut in reversed(luts)])
     
     def _get_part_color(self, part_name: str) -> tuple:
-        """Generate a consistent color for a body part"""
-        # Simple hash-based color generation
-        hash_val = hash(part_name) % 360
-        hue = hash_val / 360.0
+        """Look up the consistent color for a body part"""
+        color = self._color_cache.get(part_name)
+        if color is None:
+            color = self._color_cache[part_name] = self._part_color(part_name)
+        return color
+    
+    @staticmethod
+    def _part_color(part_name: str) -> tuple:
+        """Generate a consistent color for a body part, stable across runs"""
+        # md5 rather than hash(), which is salted per process
+        hue = int.from_bytes(hashlib.md5(part_name.encode()).digest()[:2], 'big') % 360 / 360.0
         
         # Convert HSV to RGB
-        import colorsys
         rgb = colorsys.hsv_to_rgb(hue, 0.8, 0.9)
         return tuple(int(c * 255) for c in rgb)
 
@@ -289,7 +677,9 @@ def main():
             print(f"🤖 Model: {result['model_info']['model']} on {result['model_info']['device']}")
             
             # Save results
-            save_success = processor.save_segmentation(args.image_path, args.output_dir, result)
+            futures = processor.save_segmentation(args.image_path, args.output_dir, result)
+            processor.close()
+            save_success = bool(futures) and all(future.exception() is None for future in futures)
             
             if save_success:
                 print(f"💾 Results saved to: {args.output_dir}")
@@ -7,10 +7,14 @@ Watches a folder for new images and segments body parts using Sapiens
 import os
 import time
 import queue
+import hashlib
+import sqlite3
 import threading
 import logging
+from collections import deque
+from concurrent.futures import Future
 from pathlib import Path
-from typing import Set
+from typing import List, Optional, Tuple
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
@@ -24,12 +28,134 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Optional: xxh3 hashes file contents several times faster than hashlib
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+SUPPORTED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp'}
+
+def content_digest(image_path: str) -> str:
+    """Hash a file's raw bytes, prefixed with the algorithm so digests never mix"""
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    if xxhash is not None:
+        return f"xxh3:{xxhash.xxh3_64_hexdigest(data)}"
+    return f"blake2b:{hashlib.blake2b(data, digest_size=8).hexdigest()}"
+
+class _BatchQueue:
+    """Bounded FIFO with queue.Queue's put/get/task_done/join, plus popping a batch in one critical section"""
+    
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._unfinished = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+    
+    def put(self, item):
+        """Append an item, blocking while the queue is full"""
+        with self._not_full:
+            while self.maxsize > 0 and len(self._items) >= self.maxsize:
+                self._not_full.wait()
+            self._items.append(item)
+            self._unfinished += 1
+            self._not_empty.notify()
+    
+    def get_batch(self, max_items: int, timeout: Optional[float] = None) -> list:
+        """Pop up to max_items items, waiting up to timeout for the first; raises queue.Empty"""
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._items, timeout):
+                raise queue.Empty
+            batch = [self._items.popleft() for _ in range(min(max_items, len(self._items)))]
+            self._not_full.notify(len(batch))
+            return batch
+    
+    def get(self, timeout: Optional[float] = None):
+        """Pop one item, waiting up to timeout; raises queue.Empty"""
+        return self.get_batch(1, timeout)[0]
+    
+    def task_done(self, count: int = 1):
+        """Mark count previously popped items as fully handled"""
+        with self._all_done:
+            if count > self._unfinished:
+                raise ValueError('task_done() called too many times')
+            self._unfinished -= count
+            if self._unfinished == 0:
+                self._all_done.notify_all()
+    
+    def join(self):
+        """Block until every item put so far has been marked done"""
+        with self._all_done:
+            self._all_done.wait_for(lambda: self._unfinished == 0)
+
+class ProcessedIndex:
+    """Persistent record of processed images, so a restart or a copy does not segment them again"""
+    
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS processed (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, digest TEXT)'
+        )
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(processed)')}
+        if 'digest' not in columns:
+            self._conn.execute('ALTER TABLE processed ADD COLUMN digest TEXT')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS processed_digest ON processed (digest)')
+        self._conn.commit()
+    
+    @staticmethod
+    def _stat(image_path: str) -> Optional[Tuple[float, int]]:
+        """Modification time and size of a file, or None if it is gone"""
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+    
+    def contains(self, image_path: str) -> bool:
+        """True if this exact version of the file (same mtime and size) was processed"""
+        stat = self._stat(image_path)
+        if stat is None:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM processed WHERE path = ? AND mtime = ? AND size = ?',
+                (image_path, *stat)
+            ).fetchone()
+        return row is not None
+    
+    def find_content(self, digest: str) -> Optional[str]:
+        """Path of an already processed file with this content digest, if any"""
+        with self._lock:
+            row = self._conn.execute('SELECT path FROM processed WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+        return row[0] if row else None
+    
+    def add(self, image_path: str, digest: Optional[str] = None):
+        """Record the current version of a file as processed"""
+        stat = self._stat(image_path)
+        if stat is None:
+            return
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?)', (image_path, *stat, digest))
+            self._conn.commit()
+    
+    def close(self):
+        """Close the database"""
+        with self._lock:
+            self._conn.close()
+
 class ImageHandler(FileSystemEventHandler):
     """Handles file system events for new images"""
     
-    def __init__(self, processing_queue: queue.Queue):
-        self.processing_queue = processing_queue
-        self.supported_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp'}
+    def __init__(self, enqueue, processed: ProcessedIndex):
+        self.enqueue = enqueue
+        self.processed = processed
+        self.supported_extensions = SUPPORTED_EXTENSIONS
     
     def on_created(self, event):
         if event.is_directory:
@@ -43,73 +169,148 @@ class ImageHandler(FileSystemEventHandler):
             time.sleep(0.5)
             
             if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                logger.info(f"📸 New image detected: {os.path.basename(file_path)}")
-                self.processing_queue.put(file_path)
+                if self.processed.contains(file_path):
+                    logger.info(f"⏭️  Already processed: {os.path.basename(file_path)}")
+                    return
+                if self.enqueue(file_path):
+                    logger.info(f"📸 New image detected: {os.path.basename(file_path)}")
 
 class SapiensWatcher:
     """Main watcher class that coordinates file watching and processing"""
     
+    # Processed-image database, kept next to the results it describes
+    PROCESSED_DB = '.sapiens_processed.sqlite3'
+    
     def __init__(self, watch_dir: str, output_dir: str, model_size: str = '1b', device: str = 'auto'):
         self.watch_dir = watch_dir
         self.output_dir = output_dir
         self.model_size = model_size
         self.device = device
         
-        # Queue for processing images in order
-        self.processing_queue = queue.Queue(maxsize=100)
+        # Queue for processing images in order, and the decoded images waiting for the GPU
+        self.processing_queue = _BatchQueue(maxsize=100)
+        self.gpu_queue = _BatchQueue(maxsize=4)
+        
+        # Content digests not yet recorded as processed: digest -> (first path, Future of its mask),
+        # so a copy arriving while the first is still in flight reuses its mask
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        
+        # Paths waiting in processing_queue, so the event handler and the startup
+        # scan never queue the same file twice
+        self._queued = set()
+        self._queued_lock = threading.Lock()
         
         # Components
         self.processor = None
+        self.processed = None
         self.observer = None
         self.event_handler = None
+        self.decode_thread = None
         self.processing_thread = None
         self.running = False
     
     def _initialize_processor(self):
-        """Initialize the Sapiens processor"""
+        """Initialize the Sapiens processor and the processed-image index"""
         try:
             self.processor = SapiensProcessor(model_size=self.model_size, device=self.device)
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.processed = ProcessedIndex(os.path.join(self.output_dir, self.PROCESSED_DB))
             logger.info("✅ Sapiens processor initialized")
         except Exception as e:
             logger.error(f"❌ Failed to initialize processor: {e}")
             raise
     
-    def _processing_worker(self):
-        """Worker thread that processes images from the queue"""
-        logger.info("🔄 Processing worker started")
+    def _decode_worker(self):
+        """Worker thread that decodes and resizes images ahead of the GPU"""
+        logger.info("🔄 Decode worker started")
         
         while self.running:
             try:
-                # Get image from queue (blocks for up to 1 second)
                 image_path = self.processing_queue.get(timeout=1.0)
-                
+            except queue.Empty:
+                continue
+            
+            with self._queued_lock:
+                self._queued.discard(image_path)
+            
+            digest = None
+            try:
                 # Check if already processed
-                if image_path in self.processor.processed_files:
+                if self.processed.contains(image_path):
                     logger.info(f"⏭️  Already processed: {os.path.basename(image_path)}")
-                    self.processing_queue.task_done()
                     continue
                 
-                # Process the image
-                start_time = time.time()
-                result = self.processor.segment_image(image_path)
-                processing_time = time.time() - start_time
-                
-                if result['success']:
-                    # Save results
-                    save_success = self.processor.save_segmentation(
-                        image_path, self.output_dir, result
-                    )
-                    
-                    if save_success:
-                        logger.info(f"✅ Processed in {processing_time:.1f}s: {os.path.basename(image_path)} ({result['total_parts']} parts)")
-                        self.processor.processed_files.add(image_path)
+                # Same bytes as an image still in flight: wait for its mask instead of
+                # segmenting again
+                digest = content_digest(image_path)
+                pending = self._claim(digest, image_path)
+                if pending is not None:
+                    digest = None
+                    owner, mask_future = pending
+                    if owner == image_path:
+                        logger.info(f"⏭️  Already queued: {os.path.basename(image_path)}")
                     else:
-                        logger.error(f"❌ Failed to save: {os.path.basename(image_path)}")
-                else:
-                    logger.error(f"❌ Processing failed: {os.path.basename(image_path)} - {result.get('error', 'Unknown error')}")
+                        mask_future.add_done_callback(
+                            lambda future, path=image_path, owner=owner: self._reuse_mask(path, owner, future.result())
+                        )
+                    continue
+                
+                # Same bytes as an already processed image: skip inference, but still write
+                # this name's outputs from the original's saved mask
+                original = self.processed.find_content(digest)
+                if original is not None and original != image_path:
+                    segmentation_mask = self.processor.load_saved_mask(original, self.output_dir)
+                    if segmentation_mask is not None:
+                        logger.info(f"⏭️  Duplicate of {os.path.basename(original)}, reusing its mask: {os.path.basename(image_path)}")
+                        result = self.processor.result_from_mask(image_path, segmentation_mask)
+                        self._handle_result(image_path, result, 0.0, digest)
+                        continue
+                
+                image_array = self.processor.load_image(image_path)
+                network_input = self.processor.prepare_input(image_array)
+                self.gpu_queue.put((image_path, image_array, network_input, digest))
                 
+            except Exception as e:
+                logger.error(f"❌ Processing failed: {os.path.basename(image_path)} - {e}")
+                self._release(digest, image_path)
+            finally:
                 # Mark task as done
                 self.processing_queue.task_done()
+        
+        logger.info("🛑 Decode worker stopped")
+    
+    def _processing_worker(self):
+        """Worker thread that segments decoded images from the GPU queue"""
+        logger.info("🔄 Processing worker started")
+        
+        while self.running:
+            try:
+                # Get images from queue (blocks for up to 1 second for the first),
+                # taking whatever else is already waiting, up to one batch; the
+                # decode worker already folded duplicate contents into one item
+                items = self.gpu_queue.get_batch(self.processor.batch_size, timeout=1.0)
+                
+                # Process the images
+                image_paths = [item[0] for item in items]
+                start_time = time.time()
+                try:
+                    results = self.processor.segment_batch(
+                        image_paths,
+                        images=[item[1] for item in items],
+                        inputs=[item[2] for item in items]
+                    )
+                    processing_time = time.time() - start_time
+                    
+                    for item, result in zip(items, results):
+                        self._handle_result(item[0], result, processing_time, item[3])
+                except Exception:
+                    for item in items:
+                        self._release(item[3], item[0])
+                    raise
+                finally:
+                    # Mark tasks as done
+                    self.gpu_queue.task_done(len(items))
                 
             except queue.Empty:
                 # No items in queue, continue waiting
@@ -120,18 +321,122 @@ class SapiensWatcher:
         
         logger.info("🛑 Processing worker stopped")
     
+    def _claim(self, digest: str, image_path: str) -> Optional[Tuple[str, Future]]:
+        """Register image_path as the one segmenting digest, or return the image already doing so"""
+        with self._pending_lock:
+            pending = self._pending.get(digest)
+            if pending is None:
+                self._pending[digest] = (image_path, Future())
+            return pending
+    
+    def _release(self, digest: Optional[str], image_path: str, segmentation_mask=None):
+        """
+        Hand an in-flight image's mask (None if it failed) to the copies waiting on it
+        
+        After a success the digest stays claimed until _forget(), so copies
+        arriving before its record is written still reuse the mask.
+        """
+        with self._pending_lock:
+            pending = self._pending.get(digest)
+            if pending is None or pending[0] != image_path:
+                return
+            if segmentation_mask is None:
+                del self._pending[digest]
+        
+        mask_future = pending[1]
+        if not mask_future.done():
+            mask_future.set_result(segmentation_mask)
+    
+    def _forget(self, digest: Optional[str], image_path: str):
+        """Drop image_path's claim on digest once its record is written or its save failed"""
+        with self._pending_lock:
+            pending = self._pending.get(digest)
+            if pending is not None and pending[0] == image_path:
+                del self._pending[digest]
+    
+    def _reuse_mask(self, image_path: str, original: str, segmentation_mask):
+        """Write a copy's outputs from the mask of the in-flight image with the same bytes"""
+        if segmentation_mask is None:
+            logger.error(f"❌ Processing failed: {os.path.basename(image_path)} - duplicate of {os.path.basename(original)}, which failed")
+            return
+        logger.info(f"⏭️  Duplicate of {os.path.basename(original)}, reusing its mask: {os.path.basename(image_path)}")
+        result = self.processor.result_from_mask(image_path, segmentation_mask)
+        self._handle_result(image_path, result, 0.0)
+    
+    def _handle_result(self, image_path: str, result: dict, processing_time: float,
+                       digest: Optional[str] = None):
+        """Save a segmentation result and record the image as processed"""
+        if result['success']:
+            self._release(digest, image_path, result['segmentation_mask'])
+            
+            # Save results
+            futures = self.processor.save_segmentation(
+                image_path, self.output_dir, result
+            )
+            
+            if futures:
+                self._record_when_saved(image_path, futures, digest, processing_time, result['total_parts'])
+            else:
+                logger.error(f"❌ Failed to save: {os.path.basename(image_path)}")
+                self._forget(digest, image_path)
+        else:
+            self._release(digest, image_path)
+            logger.error(f"❌ Processing failed: {os.path.basename(image_path)} - {result.get('error', 'Unknown error')}")
+    
+    def _record_when_saved(self, image_path: str, futures: List[Future], digest: Optional[str],
+                           processing_time: float, total_parts: int):
+        """Record the image as processed once every one of its writes has succeeded"""
+        lock = threading.Lock()
+        remaining = [len(futures)]
+        
+        def write_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            
+            # Last write for this image: only a complete set of files counts as processed,
+            # so failed or interrupted saves are retried by the startup catch-up
+            if any(future.exception() is not None for future in futures):
+                logger.error(f"❌ Failed to save: {os.path.basename(image_path)}")
+            else:
+                logger.info(f"✅ Processed in {processing_time:.1f}s: {os.path.basename(image_path)} ({total_parts} parts)")
+                self.processed.add(image_path, digest)
+            self._forget(digest, image_path)
+        
+        for future in futures:
+            future.add_done_callback(write_done)
+    
     def _setup_file_watcher(self):
         """Setup the file system watcher"""
         if not os.path.exists(self.watch_dir):
             logger.error(f"❌ Watch directory not found: {self.watch_dir}")
             raise FileNotFoundError(f"Watch directory not found: {self.watch_dir}")
         
-        self.event_handler = ImageHandler(self.processing_queue)
+        self.event_handler = ImageHandler(self._enqueue, self.processed)
         self.observer = Observer()
         self.observer.schedule(self.event_handler, self.watch_dir, recursive=False)
         
         logger.info(f"👀 Watching directory: {self.watch_dir}")
     
+    def _enqueue(self, image_path: str) -> bool:
+        """Queue an image unless it is already waiting; returns whether it was queued"""
+        with self._queued_lock:
+            if image_path in self._queued:
+                return False
+            self._queued.add(image_path)
+        self.processing_queue.put(image_path)
+        return True
+    
+    def _enqueue_existing(self):
+        """Queue images already in the watch directory that were not processed yet"""
+        pending = [str(path) for path in sorted(Path(self.watch_dir).iterdir())
+                   if path.suffix.lower() in SUPPORTED_EXTENSIONS and path.is_file()
+                   and not self.processed.contains(str(path))]
+        queued = sum(self._enqueue(image_path) for image_path in pending)
+        if queued:
+            logger.info(f"📂 Queued {queued} unprocessed images from {self.watch_dir}")
+    
     def start(self):
         """Start the watcher"""
         try:
@@ -145,13 +450,17 @@ class SapiensWatcher:
             self._initialize_processor()
             self._setup_file_watcher()
             
-            # Start processing thread
+            # Start decode and processing threads
             self.running = True
+            self.decode_thread = threading.Thread(target=self._decode_worker, daemon=True)
+            self.decode_thread.start()
             self.processing_thread = threading.Thread(target=self._processing_worker, daemon=True)
             self.processing_thread.start()
             
-            # Start file watcher
+            # Start file watcher before the scan so no file falls between the two;
+            # one seen by both is queued once
             self.observer.start()
+            self._enqueue_existing()
             logger.info("✅ Sapiens Watcher started!")
             logger.info("Press Ctrl+C to stop...")
             
@@ -170,23 +479,32 @@ class SapiensWatcher:
     def stop(self):
         """Stop the watcher"""
         logger.info("🛑 Stopping Sapiens Watcher...")
-        self.running = False
         
         # Stop file watcher
         if self.observer:
             self.observer.stop()
             self.observer.join()
         
-        # Wait for processing queue to empty
-        if self.processing_queue:
+        # Wait for both queues to empty while the workers are still running
+        if self.running:
             try:
                 self.processing_queue.join()
+                self.gpu_queue.join()
             except:
                 pass
+        self.running = False
+        
+        # Wait for worker threads to finish
+        for thread in (self.decode_thread, self.processing_thread):
+            if thread and thread.is_alive():
+                thread.join(timeout=5.0)
         
-        # Wait for processing thread to finish
-        if self.processing_thread and self.processing_thread.is_alive():
-            self.processing_thread.join(timeout=5.0)
+        # Let queued mask saves finish writing
+        if self.processor:
+            self.processor.close()
+        if self.processed:
+            self.processed.close()
+            self.processed = None
         
         logger.info("👋 Sapiens Watcher stopped")
 
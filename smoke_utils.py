@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+"""
+Shared helpers for the test_bodypix.py and test_sapiens.py smoke scripts
+"""
+
+# Dummy test images keyed by shape, so repeated runs reuse one buffer per shape
+_DUMMY_CACHE = {}
+
+def make_dummy_image(shape):
+    """Return a cached all-zero uint8 image of the given shape"""
+    # Imported lazily so the scripts can still report a missing NumPy themselves
+    import numpy as np
+    
+    image = _DUMMY_CACHE.get(shape)
+    if image is None:
+        image = _DUMMY_CACHE[shape] = np.zeros(shape, dtype=np.uint8)
+    return image
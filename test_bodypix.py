@@ -7,6 +7,8 @@ import sys
 import os
 from pathlib import Path
 
+from smoke_utils import make_dummy_image
+
 def test_imports():
     """Test if all required packages can be imported"""
     print("🧪 Testing imports...")
@@ -63,7 +65,6 @@ def test_bodypix_model():
     
     try:
         from bodypix import BodyPix
-        import numpy as np
         
         # Initialize BodyPix (this will download the model if needed)
         print("📥 Loading BodyPix model (this may take a while on first run)...")
@@ -71,7 +72,7 @@ def test_bodypix_model():
         print("✅ BodyPix model loaded successfully!")
         
         # Test with a dummy image
-        dummy_image = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+        dummy_image = make_dummy_image((480, 640, 3))
         print("🔄 Testing segmentation on dummy image...")
         
         result = model.predict_single(dummy_image)
@@ -7,6 +7,8 @@ import sys
 import os
 from pathlib import Path
 
+from smoke_utils import make_dummy_image
+
 def test_imports():
     """Test if all required packages can be imported"""
     print("🧪 Testing imports...")
@@ -63,7 +65,6 @@ def test_sapiens_model():
     
     try:
         from sapiens_inference import SapiensPredictor, SapiensConfig, SapiensSegmentationType
-        import numpy as np
         
         # Configure Sapiens
         config = SapiensConfig()
@@ -75,7 +76,7 @@ def test_sapiens_model():
         print("✅ Sapiens model loaded successfully!")
         
         # Test with a dummy image
-        dummy_image = np.random.randint(0, 255, (1024, 768, 3), dtype=np.uint8)
+        dummy_image = make_dummy_image((1024, 768, 3))
         print("🔄 Testing segmentation on dummy image...")
         
         result = predictor(dummy_image)